@@ -0,0 +1,191 @@
+import math
+
+import torch
+from torch.nn import functional
+
+
+def augment(images, generator=None):
+    """
+    Randomly augment a batch of images with different random parameters for every image.
+    :param images: The uint8 images of shape (B, 1, 48, 48).
+    :param generator: The random generator to use, or None to use the global generator.
+    :return: The augmented uint8 images of shape (B, 1, 48, 48).
+    """
+    if len(images) == 0:
+        return images
+    x = images.float().div_(255)
+    # Randomly adjust pixel values, which is not affected by flipping so can be done before all geometric changes.
+    x = photometric(x, generator)
+    # Randomly flip, rotate, adjust perspective, and zoom in with a single resample.
+    x = warp(x, geometric_matrices(len(x), generator))
+    return x.mul_(255).round_().clamp_(0, 255).to(torch.uint8)
+
+
+def uniform(low: float, high: float, size: int, generator=None):
+    """
+    Sample values uniformly between two bounds.
+    :param low: The lower bound.
+    :param high: The upper bound.
+    :param size: The number of values to sample.
+    :param generator: The random generator to use, or None to use the global generator.
+    :return: A tensor of the sampled values.
+    """
+    return torch.rand(size, generator=generator) * (high - low) + low
+
+
+def photometric(images, generator=None):
+    """
+    Randomly adjust the brightness, contrast, and gamma of single channel images.
+    Hue and saturation have no effect on single channel images, so no colorspace conversions are done.
+    :param images: The float images scaled between 0 and 1 of shape (B, 1, H, W).
+    :param generator: The random generator to use, or None to use the global generator.
+    :return: The adjusted images.
+    """
+    brightness = uniform(0.5, 1.5, len(images), generator).view(-1, 1, 1, 1).to(images.device)
+    contrast = uniform(0.7, 1.3, len(images), generator).view(-1, 1, 1, 1).to(images.device)
+    # Sample gamma evenly on a log scale so brightening and darkening are equally likely.
+    gamma = torch.exp(uniform(math.log(0.8), math.log(1.25), len(images), generator)).view(-1, 1, 1, 1).to(images.device)
+    images = (images * brightness).clamp_(0, 1)
+    # Blend towards the mean intensity of each image.
+    mean = images.mean(dim=(1, 2, 3), keepdim=True)
+    images = (images * contrast + mean * (1 - contrast)).clamp_(0, 1)
+    return images.pow_(gamma)
+
+
+def geometric_matrices(size: int, generator=None):
+    """
+    Get random transforms combining a flip, rotation, perspective, and crop so images only need to be resampled once.
+    :param size: The number of transforms.
+    :param generator: The random generator to use, or None to use the global generator.
+    :return: Transform matrices of shape (B, 3, 3).
+    """
+    # Randomly flip the image.
+    flip = flip_matrices(size, 0.5, generator)
+    # Randomly rotate the training data to add more variety.
+    rotation = rotation_matrices(size, 20, generator)
+    # Randomly adjust image perspective.
+    perspective = perspective_matrices(size, 0.25, 0.5, generator)
+    # Randomly zoom in on training data to add more variety.
+    crop = crop_matrices(size, (0.7, 1), (3 / 4, 4 / 3), generator)
+    # Each matrix maps output coordinates to input coordinates, so the last transform applied is the first multiplied.
+    return flip @ rotation @ perspective @ crop
+
+
+def identity_matrices(size: int):
+    """
+    Get identity transforms.
+    :param size: The number of transforms.
+    :return: Identity matrices of shape (B, 3, 3).
+    """
+    return torch.eye(3).repeat(size, 1, 1)
+
+
+def flip_matrices(size: int, p: float, generator=None):
+    """
+    Get random horizontal flip transforms.
+    Every transform maps normalized output coordinates to the normalized input coordinates to sample from.
+    :param size: The number of transforms.
+    :param p: The probability of flipping each image.
+    :param generator: The random generator to use, or None to use the global generator.
+    :return: Transform matrices of shape (B, 3, 3).
+    """
+    matrices = identity_matrices(size)
+    matrices[:, 0, 0] = torch.where(torch.rand(size, generator=generator) < p, -1.0, 1.0)
+    return matrices
+
+
+def rotation_matrices(size: int, degrees: float, generator=None):
+    """
+    Get random rotation transforms.
+    :param size: The number of transforms.
+    :param degrees: The maximum rotation in either direction in degrees.
+    :param generator: The random generator to use, or None to use the global generator.
+    :return: Transform matrices of shape (B, 3, 3).
+    """
+    angles = torch.deg2rad(uniform(-degrees, degrees, size, generator))
+    cos, sin = torch.cos(angles), torch.sin(angles)
+    matrices = identity_matrices(size)
+    matrices[:, 0, 0] = cos
+    matrices[:, 0, 1] = -sin
+    matrices[:, 1, 0] = sin
+    matrices[:, 1, 1] = cos
+    return matrices
+
+
+def perspective_matrices(size: int, distortion: float, p: float, generator=None):
+    """
+    Get random perspective transforms which move each corner of the image inwards.
+    :param size: The number of transforms.
+    :param distortion: How far each corner can move towards the center as a fraction of half the image size.
+    :param p: The probability of distorting each image.
+    :param generator: The random generator to use, or None to use the global generator.
+    :return: Transform matrices of shape (B, 3, 3).
+    """
+    corners = torch.tensor([[-1.0, -1.0], [1.0, -1.0], [1.0, 1.0], [-1.0, 1.0]])
+    # Move every corner inwards by a random amount, only for the images which are distorted.
+    offsets = torch.rand((size, 4, 2), generator=generator) * distortion
+    offsets *= (torch.rand(size, generator=generator) < p).view(-1, 1, 1)
+    moved = corners - corners.sign() * offsets
+    # Sample the original corners at the moved corners.
+    return homography(moved, corners.expand(size, 4, 2))
+
+
+def crop_matrices(size: int, scale, ratio, generator=None):
+    """
+    Get random crop transforms which zoom in on part of the image and resize it to the full image.
+    :param size: The number of transforms.
+    :param scale: The lower and upper bounds for the area of the crop as a fraction of the image area.
+    :param ratio: The lower and upper bounds for the aspect ratio of the crop.
+    :param generator: The random generator to use, or None to use the global generator.
+    :return: Transform matrices of shape (B, 3, 3).
+    """
+    area = uniform(scale[0], scale[1], size, generator)
+    aspect = torch.exp(uniform(math.log(ratio[0]), math.log(ratio[1]), size, generator))
+    # Crop sizes as fractions of the image, kept inside the image.
+    width = torch.sqrt(area * aspect).clamp_(max=1)
+    height = torch.sqrt(area / aspect).clamp_(max=1)
+    matrices = identity_matrices(size)
+    matrices[:, 0, 0] = width
+    matrices[:, 1, 1] = height
+    matrices[:, 0, 2] = uniform(-1, 1, size, generator) * (1 - width)
+    matrices[:, 1, 2] = uniform(-1, 1, size, generator) * (1 - height)
+    return matrices
+
+
+def homography(source, target):
+    """
+    Solve the perspective transforms which map four source points to four target points.
+    :param source: The source points of shape (B, 4, 2).
+    :param target: The target points of shape (B, 4, 2).
+    :return: Transform matrices of shape (B, 3, 3).
+    """
+    x, y = source[..., 0], source[..., 1]
+    u, v = target[..., 0], target[..., 1]
+    ones, zeros = torch.ones_like(x), torch.zeros_like(x)
+    # Two equations per point pair for the eight unknowns of the matrix, with the last entry fixed at one.
+    a = torch.cat([
+        torch.stack([x, y, ones, zeros, zeros, zeros, -x * u, -y * u], dim=-1),
+        torch.stack([zeros, zeros, zeros, x, y, ones, -x * v, -y * v], dim=-1)
+    ], dim=1)
+    b = torch.cat([u, v], dim=1)
+    solution = torch.linalg.solve(a, b)
+    return torch.cat([solution, torch.ones(len(solution), 1)], dim=1).view(-1, 3, 3)
+
+
+def warp(images, matrices, mode: str = "bilinear"):
+    """
+    Resample images with a transform per image.
+    :param images: The float images of shape (B, C, H, W).
+    :param matrices: Transform matrices of shape (B, 3, 3) mapping normalized output coordinates to normalized input coordinates.
+    :param mode: The interpolation mode.
+    :return: The resampled images with areas outside the input filled with zero.
+    """
+    height, width = images.shape[-2:]
+    # Normalized coordinates of the center of every output pixel.
+    ys = (torch.arange(height, dtype=torch.float32, device=images.device) * 2 + 1) / height - 1
+    xs = (torch.arange(width, dtype=torch.float32, device=images.device) * 2 + 1) / width - 1
+    grid_y, grid_x = torch.meshgrid(ys, xs, indexing="ij")
+    points = torch.stack([grid_x, grid_y, torch.ones_like(grid_x)], dim=-1).view(-1, 3)
+    mapped = points @ matrices.to(images.device).transpose(1, 2)
+    grid = (mapped[..., :2] / mapped[..., 2:]).view(-1, height, width, 2)
+    return functional.grid_sample(images, grid, mode=mode, padding_mode="zeros", align_corners=False)
@@ -0,0 +1,406 @@
+import argparse
+import os
+import tempfile
+import time
+
+import numpy
+import pandas
+import torch
+from torch.utils.data import DataLoader, Dataset
+from torchvision import transforms
+
+import augmentation
+import main
+
+
+def timed(method, *args, repeats: int = 3):
+    """
+    Time how long a method takes to run, keeping the fastest of several runs.
+    :param method: The method to time.
+    :param args: The arguments to pass to the method.
+    :param repeats: How many times to run the method.
+    :return: The fastest time in seconds and the result of the last run.
+    """
+    best = None
+    result = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = method(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def synthetic_data(rows: int, seed: int = 0):
+    """
+    Build a data frame in the same format as the FER2013 CSV filled with random images.
+    :param rows: The number of rows to generate.
+    :param seed: The random seed.
+    :return: A data frame with emotion, pixels, and usage columns.
+    """
+    generator = numpy.random.default_rng(seed)
+    images = generator.integers(0, 256, (rows, 48 * 48))
+    return pandas.DataFrame({
+        'emotion': generator.integers(0, 7, rows),
+        'pixels': [" ".join(map(str, image)) for image in images],
+        'Usage': numpy.where(generator.random(rows) < 0.8, 'Training', 'PublicTest')
+    })
+
+
+def legacy_prepare_data(data):
+    """
+    The original row by row parser, kept as a reference to benchmark against.
+    :param data: The data frame loaded from the CSV with emotions and pixel data.
+    :return: Images and labels ready for PyTorch.
+    """
+    images = numpy.zeros(shape=(len(data), 48, 48))
+    labels = numpy.array(list(map(int, data['emotion'])))
+    for i, row in enumerate(data.index):
+        image = numpy.fromstring(data.loc[row, 'pixels'], dtype=int, sep=' ')
+        image = numpy.reshape(image, (48, 48))
+        images[i] = image
+    images = images.reshape((images.shape[0], 48, 48, 1))
+    images = images.astype('float32') / 255
+    return images, labels
+
+
+class LegacyAugmentedDataset(Dataset):
+    """
+    The original per-item augmentation pipeline, kept as a reference to benchmark against.
+    """
+
+    def __init__(self, dataset):
+        """
+        Create the dataset.
+        :param dataset: The dataset to augment.
+        """
+        self.dataset = dataset
+        self.transform = legacy_transform()
+
+    def __len__(self):
+        """
+        Get the length of the dataset.
+        :return: The length of the dataset.
+        """
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        """
+        Get an image and its label from the dataset.
+        :param idx: The index to get.
+        :return: The uint8 image with transformations applied and its label.
+        """
+        return self.transform(self.dataset.images[idx]), self.dataset.labels[idx]
+
+
+def legacy_transform():
+    """
+    The original chain of torchvision augmentations applied one image at a time.
+    :return: The composed transforms.
+    """
+    return transforms.Compose([
+        transforms.RandomHorizontalFlip(),
+        transforms.ColorJitter(brightness=0.5, contrast=0.3, hue=0.3, saturation=0.3),
+        transforms.RandomRotation(20),
+        transforms.RandomPerspective(0.25),
+        transforms.RandomResizedCrop(48, (0.7, 1))
+    ])
+
+
+def random_dataset(rows: int, augment: bool = False, seed: int = 0):
+    """
+    Build a dataset of random images.
+    :param rows: The number of images in the dataset.
+    :param augment: True to augment the dataset, false otherwise.
+    :param seed: The random seed.
+    :return: The dataset.
+    """
+    generator = numpy.random.default_rng(seed)
+    return main.FaceDataset(generator.integers(0, 256, (rows, 48, 48), dtype=numpy.uint8), generator.integers(0, 7, rows), augment)
+
+
+def benchmark_parse(sizes):
+    """
+    Compare the row by row parser against the bulk parser.
+    :param sizes: The dataset sizes to test.
+    :return: Nothing.
+    """
+    print(f"{'Rows':>8}  {'Legacy (s)':>10}  {'Bulk (s)':>10}  {'Speedup':>8}")
+    for rows in sizes:
+        data = synthetic_data(rows)
+        legacy_time, (legacy_images, legacy_labels) = timed(legacy_prepare_data, data)
+        bulk_time, (bulk_images, bulk_labels) = timed(main.prepare_data, data)
+        if not numpy.array_equal(legacy_images, bulk_images) or not numpy.array_equal(legacy_labels, bulk_labels):
+            raise ValueError(f"Bulk parser output differs from the legacy parser for {rows} rows.")
+        print(f"{rows:>8}  {legacy_time:>10.4f}  {bulk_time:>10.4f}  {legacy_time / bulk_time:>7.1f}x")
+
+
+def benchmark_cache(path: str):
+    """
+    Compare parsing the CSV against loading the memory-mapped dataset cache.
+    :param path: The path of the CSV.
+    :return: Nothing.
+    """
+    with tempfile.TemporaryDirectory() as cache:
+        parse_time, parsed = timed(main.load_data, path, repeats=1)
+        main.write_cache(path, cache, parsed)
+        cache_time, cached = timed(main.load_cache, path, cache)
+        for parsed_array, cached_array in zip(parsed, cached):
+            if not numpy.array_equal(parsed_array, cached_array):
+                raise ValueError("Cached dataset differs from the parsed dataset.")
+        del cached
+    print(f"Parse CSV: {parse_time:.4f} s\n"
+          f"Load Cache: {cache_time:.4f} s\n"
+          f"Speedup: {parse_time / cache_time:.1f}x")
+
+
+def loader_throughput(loader, epochs: int):
+    """
+    Measure how many images per second a loader produces, including scaling them for the network.
+    :param loader: The loader to iterate.
+    :param epochs: The number of epochs to iterate.
+    :return: The number of images per second.
+    """
+    total = 0
+    start = time.perf_counter()
+    for _ in range(epochs):
+        for raw_image, raw_label in loader:
+            image, label = main.to_images(raw_image), main.to_tensor(raw_label)
+            total += len(label)
+    return total / (time.perf_counter() - start)
+
+
+def benchmark_loader(rows: int, batches, epochs: int):
+    """
+    Compare the default data loader against the batch loader.
+    :param rows: The number of images in the dataset.
+    :param batches: The batch sizes to test.
+    :param epochs: The number of epochs to iterate for each measurement.
+    :return: Nothing.
+    """
+    dataset = random_dataset(rows)
+    print(f"{'Batch':>6}  {'DataLoader (img/s)':>18}  {'BatchLoader (img/s)':>19}  {'Speedup':>8}")
+    for batch in batches:
+        default = loader_throughput(DataLoader(dataset, batch_size=batch, shuffle=True), epochs)
+        fast = loader_throughput(main.BatchLoader(dataset, batch, True), epochs)
+        print(f"{batch:>6}  {default:>18.0f}  {fast:>19.0f}  {fast / default:>7.1f}x")
+
+
+def benchmark_augment(rows: int, batch: int):
+    """
+    Compare the per-item augmentation pipeline against batched augmentation and unaugmented loading.
+    :param rows: The number of images in the dataset.
+    :param batch: The batch size.
+    :return: Nothing.
+    """
+    normal = random_dataset(rows)
+    augmented = random_dataset(rows, True)
+    legacy = loader_throughput(DataLoader(LegacyAugmentedDataset(normal), batch_size=batch, shuffle=True), 1)
+    batched = loader_throughput(main.BatchLoader(augmented, batch, True), 1)
+    unaugmented = loader_throughput(main.BatchLoader(normal, batch, True), 1)
+    print(f"Per-Item Augmented: {legacy:.0f} img/s\n"
+          f"Batched Augmented: {batched:.0f} img/s ({batched / legacy:.1f}x)\n"
+          f"Unaugmented: {unaugmented:.0f} img/s")
+
+
+def separate_warps(images):
+    """
+    Apply the geometric augmentations as separate resamples, kept as a reference to benchmark against.
+    :param images: The float images of shape (B, 1, 48, 48).
+    :return: The augmented images.
+    """
+    images = augmentation.warp(images, augmentation.flip_matrices(len(images), 0.5))
+    images = augmentation.warp(images, augmentation.rotation_matrices(len(images), 20), "nearest")
+    images = augmentation.warp(images, augmentation.perspective_matrices(len(images), 0.25, 0.5))
+    return augmentation.warp(images, augmentation.crop_matrices(len(images), (0.7, 1), (3 / 4, 4 / 3)))
+
+
+def benchmark_geometric(batch: int, batches: int):
+    """
+    Compare the original per-image geometric augmentations against separate batched resamples and a single fused resample.
+    :param batch: The batch size.
+    :param batches: The number of batches to augment.
+    :return: Nothing.
+    """
+    images = random_dataset(batch).images.float().div_(255)
+    chain = transforms.Compose([
+        transforms.RandomRotation(20),
+        transforms.RandomPerspective(0.25),
+        transforms.RandomResizedCrop(48, (0.7, 1))
+    ])
+
+    def per_image():
+        for _ in range(batches):
+            torch.stack([chain(transforms.RandomHorizontalFlip()(image)) for image in images])
+
+    def separate():
+        for _ in range(batches):
+            separate_warps(images)
+
+    def fused():
+        for _ in range(batches):
+            augmentation.warp(images, augmentation.geometric_matrices(len(images)))
+
+    total = batch * batches
+    legacy_time, _ = timed(per_image, repeats=1)
+    separate_time, _ = timed(separate)
+    fused_time, _ = timed(fused)
+    print(f"Per-Image Compose: {total / legacy_time:.0f} img/s\n"
+          f"Separate Batched Warps: {total / separate_time:.0f} img/s ({legacy_time / separate_time:.1f}x)\n"
+          f"Fused Batched Warp: {total / fused_time:.0f} img/s ({legacy_time / fused_time:.1f}x)")
+
+
+def benchmark_photometric(batch: int, batches: int):
+    """
+    Compare the original per-image color jitter against batched grayscale photometric augmentation.
+    :param batch: The batch size.
+    :param batches: The number of batches to augment.
+    :return: Nothing.
+    """
+    images = random_dataset(batch).images.float().div_(255)
+    jitter = transforms.ColorJitter(brightness=0.5, contrast=0.3, hue=0.3, saturation=0.3)
+
+    def per_image():
+        for _ in range(batches):
+            torch.stack([jitter(image) for image in images])
+
+    def batched():
+        for _ in range(batches):
+            augmentation.photometric(images.clone())
+
+    total = batch * batches
+    legacy_time, _ = timed(per_image, repeats=1)
+    batched_time, _ = timed(batched)
+    print(f"Per-Image Color Jitter: {total / legacy_time:.0f} img/s\n"
+          f"Batched Photometric: {total / batched_time:.0f} img/s ({legacy_time / batched_time:.1f}x)")
+
+
+def benchmark_ingest(path: str, workers: int):
+    """
+    Measure how many CSV rows per second are parsed into the cache with different numbers of processes.
+    :param path: The path of the CSV.
+    :param workers: The largest number of processes to test.
+    :return: Nothing.
+    """
+    print(f"{'Workers':>7}  {'Time (s)':>9}  {'Rows/s':>9}")
+    with tempfile.TemporaryDirectory() as cache:
+        streamed_time, streamed = timed(main.stream_cache, path, cache, repeats=1)
+        rows = sum(len(labels) for labels in streamed[1::2])
+        del streamed
+        print(f"{'Stream':>7}  {streamed_time:>9.4f}  {rows / streamed_time:>9.0f}")
+        for count in range(1, workers + 1):
+            parallel_time, parallel = timed(main.parallel_cache, path, cache, count, repeats=1)
+            del parallel
+            print(f"{count:>7}  {parallel_time:>9.4f}  {rows / parallel_time:>9.0f}")
+
+
+def benchmark_precision(path: str, names, steps: int, batch: int):
+    """
+    Compare training throughput and accuracy in float32 and bfloat16 mixed precision.
+    :param path: The path of the CSV.
+    :param names: The model architectures to test.
+    :param steps: The number of training batches for each model.
+    :param batch: The batch size.
+    :return: Nothing.
+    """
+    train_images, train_labels, test_images, test_labels = main.load_data(path, f"{os.path.dirname(path)}/Cache")
+    training = main.BatchLoader(main.FaceDataset(train_images, train_labels), batch, True)
+    testing = main.BatchLoader(main.FaceDataset(test_images, test_labels), batch)
+    print(f"{'Model':>8}  {'Precision':>9}  {'Train (img/s)':>13}  {'Accuracy':>8}")
+    for name in names:
+        for mixed in [False, True]:
+            torch.manual_seed(0)
+            model = main.NeuralNetwork(name, mixed=mixed)
+            total = 0
+            start = time.perf_counter()
+            while total < steps * batch:
+                for raw_image, raw_label in training:
+                    model.optimize(main.to_images(raw_image), main.to_tensor(raw_label))
+                    total += len(raw_label)
+                    if total >= steps * batch:
+                        break
+            elapsed = time.perf_counter() - start
+            accuracy = main.evaluate(model, testing)[0]
+            print(f"{name:>8}  {'bfloat16' if mixed else 'float32':>9}  {total / elapsed:>13.0f}  {accuracy:>7.2f}%")
+
+
+def benchmark_channels(names, batches, repeats: int):
+    """
+    Compare training and inference throughput in the contiguous and channels last memory formats.
+    :param names: The model architectures to test.
+    :param batches: The batch sizes to test.
+    :param repeats: How many batches to time for each measurement.
+    :return: Nothing.
+    """
+    print(f"{'Model':>8}  {'Batch':>5}  {'Format':>13}  {'Train (img/s)':>13}  {'Inference (img/s)':>17}")
+    for name in names:
+        for batch in batches:
+            raw_image = torch.randint(0, 256, (batch, 1, 48, 48), dtype=torch.uint8)
+            label = main.to_tensor(torch.randint(0, 7, (batch,)))
+            for channels_last in [False, True]:
+                torch.manual_seed(0)
+                model = main.NeuralNetwork(name, channels_last=channels_last)
+                image = main.to_images(raw_image, memory_format=model.memory_format)
+                train_time, _ = timed(lambda: [model.optimize(image, label) for _ in range(repeats)])
+                model.eval()
+                inference_time, _ = timed(lambda: [model.predict(image) for _ in range(repeats)])
+                print(f"{name:>8}  {batch:>5}  {'Channels Last' if channels_last else 'Contiguous':>13}  {batch * repeats / train_time:>13.0f}  {batch * repeats / inference_time:>17.0f}")
+
+
+if __name__ == '__main__':
+    try:
+        desc = "Face Expression Recognition Benchmarks\n--------------------------------------"
+        parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=desc)
+        subparsers = parser.add_subparsers(dest="benchmark", required=True)
+        parse_parser = subparsers.add_parser("parse", help="Compare the legacy and bulk pixel parsers.")
+        parse_parser.add_argument("-s", "--sizes", type=int, nargs="+", help="Dataset sizes to test.", default=[1000, 5000, 20000])
+        cache_parser = subparsers.add_parser("cache", help="Compare parsing the CSV against loading the dataset cache.")
+        cache_parser.add_argument("-p", "--path", type=str, help="The CSV to load.", default=f"{os.getcwd()}/Data.csv")
+        loader_parser = subparsers.add_parser("loader", help="Compare the default data loader against the batch loader.")
+        loader_parser.add_argument("-r", "--rows", type=int, help="The number of images in the dataset.", default=28709)
+        loader_parser.add_argument("-b", "--batches", type=int, nargs="+", help="Batch sizes to test.", default=[32, 64, 256])
+        loader_parser.add_argument("-e", "--epochs", type=int, help="The number of epochs to iterate for each measurement.", default=1)
+        augment_parser = subparsers.add_parser("augment", help="Compare per-item and batched augmentation.")
+        augment_parser.add_argument("-r", "--rows", type=int, help="The number of images in the dataset.", default=10000)
+        augment_parser.add_argument("-b", "--batch", type=int, help="The batch size.", default=64)
+        geometric_parser = subparsers.add_parser("geometric", help="Compare per-image, separate, and fused geometric augmentation.")
+        geometric_parser.add_argument("-b", "--batch", type=int, help="The batch size.", default=64)
+        geometric_parser.add_argument("-n", "--batches", type=int, help="The number of batches to augment.", default=50)
+        photometric_parser = subparsers.add_parser("photometric", help="Compare per-image color jitter and batched photometric augmentation.")
+        photometric_parser.add_argument("-b", "--batch", type=int, help="The batch size.", default=64)
+        photometric_parser.add_argument("-n", "--batches", type=int, help="The number of batches to augment.", default=50)
+        ingest_parser = subparsers.add_parser("ingest", help="Measure parsing the CSV into the cache with different numbers of processes.")
+        ingest_parser.add_argument("-p", "--path", type=str, help="The CSV to load.", default=f"{os.getcwd()}/Data.csv")
+        ingest_parser.add_argument("-n", "--workers", type=int, help="The largest number of processes to test.", default=os.cpu_count())
+        precision_parser = subparsers.add_parser("precision", help="Compare float32 and bfloat16 mixed precision training.")
+        precision_parser.add_argument("-p", "--path", type=str, help="The CSV to load.", default=f"{os.getcwd()}/Data.csv")
+        precision_parser.add_argument("-m", "--models", type=str, nargs="+", help="The model architectures to test.", default=["simple", "expanded", "resnet"])
+        precision_parser.add_argument("-s", "--steps", type=int, help="The number of training batches for each model.", default=200)
+        precision_parser.add_argument("-b", "--batch", type=int, help="The batch size.", default=64)
+        channels_parser = subparsers.add_parser("channels", help="Compare the contiguous and channels last memory formats.")
+        channels_parser.add_argument("-m", "--models", type=str, nargs="+", help="The model architectures to test.", default=["simple", "expanded", "resnet"])
+        channels_parser.add_argument("-b", "--batches", type=int, nargs="+", help="Batch sizes to test.", default=[1, 64, 256])
+        channels_parser.add_argument("-r", "--repeats", type=int, help="How many batches to time for each measurement.", default=5)
+        a = vars(parser.parse_args())
+        if a["benchmark"] == "parse":
+            benchmark_parse(a["sizes"])
+        elif a["benchmark"] == "cache":
+            benchmark_cache(a["path"])
+        elif a["benchmark"] == "loader":
+            benchmark_loader(a["rows"], a["batches"], a["epochs"])
+        elif a["benchmark"] == "augment":
+            benchmark_augment(a["rows"], a["batch"])
+        elif a["benchmark"] == "geometric":
+            benchmark_geometric(a["batch"], a["batches"])
+        elif a["benchmark"] == "photometric":
+            benchmark_photometric(a["batch"], a["batches"])
+        elif a["benchmark"] == "ingest":
+            benchmark_ingest(a["path"], a["workers"])
+        elif a["benchmark"] == "precision":
+            benchmark_precision(a["path"], a["models"], a["steps"], a["batch"])
+        elif a["benchmark"] == "channels":
+            benchmark_channels(a["models"], a["batches"], a["repeats"])
+    except KeyboardInterrupt:
+        print("Benchmark Stopped.")
+    except ValueError as error:
+        print(error)
@@ -0,0 +1,193 @@
+import argparse
+import json
+import os
+
+import numpy
+
+import main
+
+
+def exact_groups(images):
+    """
+    Group images which are exactly identical.
+    :param images: The uint8 images of shape (N, 48, 48).
+    :return: The group ID of every image.
+    """
+    # View every image as a single value so identical images compare equal.
+    rows = numpy.ascontiguousarray(images).reshape(len(images), -1).view(numpy.dtype((numpy.void, 48 * 48)))
+    return numpy.unique(rows, return_inverse=True)[1].reshape(-1)
+
+
+def perceptual_hashes(images):
+    """
+    Hash images so faces which only differ slightly, such as through compression or small brightness changes, hash the same or similarly.
+    :param images: The uint8 images of shape (N, 48, 48).
+    :return: A 64-bit hash of every image.
+    """
+    # Average each 6x6 block down to an 8x8 image and mark which blocks are brighter than the median block.
+    blocks = numpy.asarray(images, dtype=numpy.float32).reshape(-1, 8, 6, 8, 6).mean(axis=(2, 4)).reshape(-1, 64)
+    bits = blocks > numpy.median(blocks, axis=1, keepdims=True)
+    return numpy.packbits(bits, axis=1).view(">u8").reshape(-1).astype(numpy.uint64)
+
+
+def find(parents, index: int):
+    """
+    Find the root of a group in a union-find structure, compressing the path along the way.
+    :param parents: The parent of every element.
+    :param index: The element to find the root of.
+    :return: The root of the group.
+    """
+    root = index
+    while parents[root] != root:
+        root = parents[root]
+    while parents[index] != root:
+        parents[index], index = root, parents[index]
+    return root
+
+
+def hamming(first, second):
+    """
+    Count how many bits differ between hashes.
+    :param first: The first hashes.
+    :param second: The second hashes, which are broadcast against the first.
+    :return: The number of differing bits.
+    """
+    return numpy.bitwise_count(numpy.asarray(first) ^ numpy.asarray(second))
+
+
+def near_groups(hashes, distance: int, chunk: int = 1 << 22):
+    """
+    Group images whose perceptual hashes differ by at most a number of bits.
+    :param hashes: The perceptual hash of every image.
+    :param distance: The largest number of bits two hashes can differ by to be grouped.
+    :param chunk: The largest number of hash pairs to compare at once, limiting memory use.
+    :return: The group ID of every image.
+    """
+    # Identical hashes are always grouped, so only distinct hashes need to be compared.
+    hashes, inverse = numpy.unique(hashes, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    if distance < 1 or len(hashes) == 0:
+        return inverse
+    parents = numpy.arange(len(hashes))
+    # If two hashes differ by at most "distance" bits, at least one of "distance + 1" bands of bits must match exactly.
+    bands = min(distance + 1, 64)
+    edges = numpy.linspace(0, 64, bands + 1).astype(int)
+    for low, high in zip(edges[:-1], edges[1:]):
+        band = (hashes >> numpy.uint64(low)) & numpy.uint64((1 << (high - low)) - 1)
+        order = numpy.argsort(band, kind="stable")
+        starts = numpy.flatnonzero(numpy.diff(band[order], prepend=band[order][0] + numpy.uint64(1)) != 0)
+        for members in numpy.split(order, starts[1:]):
+            if len(members) < 2:
+                continue
+            candidates = hashes[members]
+            # Check the real distance of every candidate pair which shares this band, a few rows at a time.
+            rows = max(chunk // len(members), 1)
+            for row in range(0, len(members), rows):
+                close = hamming(candidates[row:row + rows, None], candidates[None, :]) <= distance
+                for first, second in zip(*numpy.nonzero(numpy.triu(close, row + 1))):
+                    parents[find(parents, members[row + first])] = find(parents, members[second])
+    roots = numpy.array([find(parents, index) for index in range(len(hashes))])
+    return roots[inverse]
+
+
+def build_index(train_images, train_labels, test_images, test_labels, distance: int = 0):
+    """
+    Build an index of groups of duplicate images across the training and testing data.
+    :param train_images: The uint8 training images of shape (N, 48, 48).
+    :param train_labels: The training labels.
+    :param test_images: The uint8 testing images of shape (N, 48, 48).
+    :param test_labels: The testing labels.
+    :param distance: The largest number of bits perceptual hashes can differ by to be near duplicates.
+    :return: A list of every group with more than one image.
+    """
+    images = numpy.concatenate([numpy.asarray(train_images), numpy.asarray(test_images)])
+    labels = numpy.concatenate([numpy.asarray(train_labels), numpy.asarray(test_labels)])
+    splits = numpy.array(["Train"] * len(train_labels) + ["Test"] * len(test_labels))
+    indices = numpy.concatenate([numpy.arange(len(train_labels)), numpy.arange(len(test_labels))])
+    exact = exact_groups(images)
+    hashes = perceptual_hashes(images)
+    # Identical images always have identical perceptual hashes, so near duplicate groups contain every exact duplicate group.
+    groups = near_groups(hashes, distance)
+    order = numpy.argsort(groups, kind="stable")
+    starts = numpy.flatnonzero(numpy.diff(groups[order], prepend=-1) != 0)
+    index = []
+    for members in numpy.split(order, starts[1:]):
+        if len(members) < 2:
+            continue
+        index.append({
+            'Exact': bool(numpy.all(exact[members] == exact[members[0]])),
+            'Cross Split': bool(len(set(splits[members])) > 1),
+            'Members': [{'Split': str(splits[member]), 'Index': int(indices[member]), 'Label': int(labels[member]), 'Hash': f"{int(hashes[member]):016x}"} for member in members]
+        })
+    return index
+
+
+def deduplicate(train_images, train_labels, index, distance: int = 0):
+    """
+    Remove duplicate training images and any training images which duplicate a testing image.
+    Groups can chain images which are not themselves near each other, so images are compared directly rather than removing whole groups.
+    :param train_images: The uint8 training images of shape (N, 48, 48).
+    :param train_labels: The training labels.
+    :param index: The duplicate groups from "build_index".
+    :param distance: The largest number of bits perceptual hashes can differ by to be near duplicates.
+    :return: The remaining training images and labels.
+    """
+    remove = set()
+    for group in index:
+        train = [member for member in group['Members'] if member['Split'] == 'Train']
+        test = numpy.array([int(member['Hash'], 16) for member in group['Members'] if member['Split'] == 'Test'], dtype=numpy.uint64)
+        kept = []
+        for member in train:
+            hashed = numpy.uint64(int(member['Hash'], 16))
+            # Training images near a testing image leak the answer, so they are removed.
+            if len(test) > 0 and hamming(test, hashed).min() <= distance:
+                remove.add(member['Index'])
+            # Keep the first of any training images which are near each other.
+            elif len(kept) > 0 and hamming(numpy.array(kept, dtype=numpy.uint64), hashed).min() <= distance:
+                remove.add(member['Index'])
+            else:
+                kept.append(hashed)
+    keep = numpy.setdiff1d(numpy.arange(len(train_labels)), numpy.fromiter(remove, dtype=numpy.int64, count=len(remove)))
+    if len(keep) == 0:
+        raise ValueError("Deduplication would remove every training image, use a smaller distance.")
+    return numpy.asarray(train_images)[keep], numpy.asarray(train_labels)[keep]
+
+
+def main_deduplicate(distance: int, rebuild: bool):
+    """
+    Find duplicate images in "Data.csv" and write a deduplicated dataset cache.
+    :param distance: The largest number of bits perceptual hashes can differ by to be near duplicates.
+    :param rebuild: True to rebuild the dataset cache even if "Data.csv" has not changed.
+    :return: Nothing.
+    """
+    path = f"{os.getcwd()}/Data.csv"
+    if not os.path.exists(path):
+        print("Data.csv missing, visit https://github.com/StevenRice99/COMP-4730-Project-2#setup for instructions.")
+        return
+    print("Loading data...")
+    train_images, train_labels, test_images, test_labels = main.load_data(path, f"{os.getcwd()}/Cache", rebuild)
+    print("Finding duplicates...")
+    index = build_index(train_images, train_labels, test_images, test_labels, distance)
+    with open(f"{os.getcwd()}/Cache/Duplicates.json", "w") as file:
+        json.dump({'Distance': distance, 'Groups': index}, file)
+    deduplicated_images, deduplicated_labels = deduplicate(train_images, train_labels, index, distance)
+    main.write_cache(path, f"{os.getcwd()}/Cache/Deduplicated", (deduplicated_images, deduplicated_labels, test_images, test_labels))
+    print(f"Duplicate Groups: {len(index)}\n"
+          f"Exact Groups: {sum(group['Exact'] for group in index)}\n"
+          f"Cross Split Groups: {sum(group['Cross Split'] for group in index)}\n"
+          f"Conflicting Label Groups: {sum(len(set(member['Label'] for member in group['Members'])) > 1 for group in index)}\n"
+          f"Training Images: {len(train_labels)} -> {len(deduplicated_labels)}")
+
+
+if __name__ == '__main__':
+    try:
+        desc = "Face Expression Recognition Deduplication\n-----------------------------------------"
+        parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=desc)
+        parser.add_argument("-d", "--distance", type=int, help="The largest number of bits perceptual hashes can differ by to be near duplicates.", default=0)
+        parser.add_argument("-r", "--rebuild", help="Rebuild the dataset cache even if \"Data.csv\" has not changed.", action="store_true")
+        a = vars(parser.parse_args())
+        main_deduplicate(a["distance"], a["rebuild"])
+    except KeyboardInterrupt:
+        print("Deduplication Stopped.")
+    except ValueError as error:
+        print(error)
@@ -0,0 +1,93 @@
+import argparse
+import json
+import threading
+import time
+import urllib.request
+
+import numpy
+
+
+def send(url: str, body: bytes):
+    """
+    Send raw pixels to the server to predict.
+    :param url: The URL of the server.
+    :param body: The raw pixels.
+    :return: The response of the server.
+    """
+    request = urllib.request.Request(f"{url}/predict", body, {"Content-Type": "application/octet-stream"})
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())
+
+
+def generate_load(url: str, requests: int, concurrency: int, images: int, seed: int = 0):
+    """
+    Send requests to the server from multiple threads at once.
+    :param url: The URL of the server.
+    :param requests: The number of requests to send.
+    :param concurrency: The number of requests to have waiting at once.
+    :param images: The number of images in each request.
+    :param seed: The seed for the random images.
+    :return: The latency of every request in milliseconds and the total time taken in seconds.
+    """
+    rng = numpy.random.default_rng(seed)
+    bodies = [rng.integers(0, 256, (images, 48, 48), dtype=numpy.uint8).tobytes() for _ in range(min(requests, 64))]
+    latencies = []
+    lock = threading.Lock()
+    counter = iter(range(requests))
+
+    def worker():
+        while True:
+            with lock:
+                index = next(counter, None)
+            if index is None:
+                return
+            start = time.perf_counter()
+            send(url, bodies[index % len(bodies)])
+            with lock:
+                latencies.append((time.perf_counter() - start) * 1000)
+
+    threads = [threading.Thread(target=worker) for _ in range(max(concurrency, 1))]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, time.perf_counter() - start
+
+
+def main_load(url: str, requests: int, concurrency: int, images: int):
+    """
+    Compare the throughput of sending requests one at a time against sending concurrent requests the server can batch.
+    :param url: The URL of the server.
+    :param requests: The number of requests to send for each test.
+    :param concurrency: The number of requests to have waiting at once.
+    :param images: The number of images in each request.
+    :return: Nothing.
+    """
+    # Warm up the server so the first requests do not include any lazy initialization.
+    generate_load(url, min(requests, 10), 1, images)
+    print(f"{'Concurrency':>11}  {'Requests/s':>10}  {'Images/s':>8}  {'P50 (ms)':>8}  {'P95 (ms)':>8}  {'P99 (ms)':>8}")
+    for level in sorted({1, max(concurrency, 1)}):
+        latencies, elapsed = generate_load(url, requests, level, images)
+        p50, p95, p99 = numpy.percentile(latencies, [50, 95, 99])
+        print(f"{level:>11}  {requests / elapsed:>10.1f}  {requests * images / elapsed:>8.1f}  {p50:>8.2f}  {p95:>8.2f}  {p99:>8.2f}")
+    with urllib.request.urlopen(f"{url}/stats") as response:
+        statistics = json.loads(response.read())
+    print(f"Batch Sizes: {statistics['Batch Sizes']}\n"
+          f"Queue Depths: {statistics['Queue Depths']}")
+
+
+if __name__ == '__main__':
+    try:
+        desc = "Face Expression Recognition Load Generator\n------------------------------------------"
+        parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=desc)
+        parser.add_argument("-u", "--url", type=str, help="The URL of the server.", default="http://127.0.0.1:8000")
+        parser.add_argument("-r", "--requests", type=int, help="The number of requests to send for each test.", default=500)
+        parser.add_argument("-c", "--concurrency", type=int, help="The number of requests to have waiting at once.", default=32)
+        parser.add_argument("-i", "--images", type=int, help="The number of images in each request.", default=1)
+        a = vars(parser.parse_args())
+        main_load(a["url"].rstrip("/"), a["requests"], a["concurrency"], a["images"])
+    except KeyboardInterrupt:
+        print("Load Generation Stopped.")
+    except ValueError as error:
+        print(error)
@@ -1,5 +1,10 @@
 import argparse
+import hashlib
+import io
+import json
+import multiprocessing
 import os
+import queue
 import time
 
 import numpy
@@ -7,14 +12,35 @@ import pandas
 import torch
 import torchvision.utils
 from torch import nn
-from torch.utils.data import DataLoader, Dataset
+from torch.utils.data import BatchSampler, DataLoader, Dataset, RandomSampler, SequentialSampler
 from torchsummary import summary
-from torchvision import transforms
 from torchviz import make_dot
 from tqdm import tqdm
 
+import augmentation
 import model_builder
 
+# The arrays stored in the dataset cache.
+CACHE_FILES = ["Train Images", "Train Labels", "Test Images", "Test Labels"]
+
+# The number of CSV rows to parse at once when building the cache.
+CHUNK_ROWS = 4096
+
+# The largest number of CSV bytes a worker parses at once when building the cache in parallel.
+RANGE_BYTES = 32 * 1024 * 1024
+
+# The size of the headers of cached arrays, large enough for any shape and aligned for memory mapping.
+NPY_HEADER = 128
+
+# The values computed by "dataset_statistics".
+STATISTICS = ['Counts', 'Mean', 'Std', 'Class Means']
+
+# The batch sizes to measure inference latency and throughput with.
+BENCHMARK_BATCHES = [1, 8, 64, 256]
+
+# The facial expressions in the order of their labels.
+EXPRESSIONS = ["Angry", "Disgust", "Fear", "Happy", "Sad", "Surprise", "Neutral"]
+
 
 class FaceDataset(Dataset):
     """
@@ -24,30 +50,15 @@ class FaceDataset(Dataset):
     def __init__(self, images, labels, augment: bool = False):
         """
         Create the dataset.
-        :param images: The images parsed from the CSV.
+        :param images: The uint8 images parsed from the CSV of shape (N, 48, 48) or a shared store from "image_store".
         :param labels: The labels parsed from the CSV.
         :param augment: True to augment data augmented, false otherwise.
         """
-        self.images = torch.tensor(images, dtype=torch.float32)
-        # Rearrange axis, so they are in proper input order and appear visually upright.
-        self.images = torch.swapaxes(self.images, 1, 3)
-        self.images = torch.swapaxes(self.images, 2, 3)
-        self.labels = torch.tensor(labels, dtype=torch.int)
-        if augment:
-            self.transform = transforms.Compose([
-                # Randomly flip the image.
-                transforms.RandomHorizontalFlip(),
-                # Randomly adjust pixel values.
-                transforms.ColorJitter(brightness=0.5, contrast=0.3, hue=0.3, saturation=0.3),
-                # Randomly rotate the training data to add more variety.
-                transforms.RandomRotation(20),
-                # Randomly adjust image perspective.
-                transforms.RandomPerspective(0.25),
-                # Randomly zoom in on training data to add more variety.
-                transforms.RandomResizedCrop(48, (0.7, 1))
-            ])
-        else:
-            self.transform = None
+        # Keep the raw uint8 pixels without copying them, scaling is done per batch by "to_images".
+        self.images = image_store(images)
+        self.labels = torch.as_tensor(labels, dtype=torch.long)
+        # Augmentations are defined in "augmentation.py" and applied to whole batches when loaded.
+        self.augment = augment
 
     def __len__(self):
         """
@@ -60,9 +71,148 @@ class FaceDataset(Dataset):
         """
         Get an image and its label from the dataset.
         :param idx: The index to get.
-        :return: The image with transformations applied and its label.
+        :return: The uint8 image with augmentations applied and its label.
+        """
+        return (augmentation.augment(self.images[idx].unsqueeze(0))[0] if self.augment else self.images[idx]), self.labels[idx]
+
+    def __getitems__(self, indices):
+        """
+        Get a batch of images and their labels from the dataset, used by data loaders in place of single items.
+        :param indices: The indices to get.
+        :return: The uint8 images with augmentations applied and their labels.
+        """
+        return self.batch(torch.as_tensor(indices, dtype=torch.long))
+
+    def batch(self, indices):
+        """
+        Get a batch of images and their labels from the dataset.
+        :param indices: The indices to get as a tensor or a slice.
+        :return: The uint8 images with augmentations applied and their labels.
+        """
+        images = self.images[indices]
+        return (augmentation.augment(images) if self.augment else images), self.labels[indices]
+
+
+class BatchLoader:
+    """
+    Iterate whole batches sliced directly out of a dataset's tensors rather than collating single items.
+    """
+
+    def __init__(self, dataset, batch_size: int, shuffle: bool = False):
+        """
+        Create the batch loader.
+        :param dataset: The dataset to load.
+        :param batch_size: The batch size.
+        :param shuffle: True to shuffle the order every time the loader is iterated, false otherwise.
+        """
+        self.dataset = dataset
+        self.batch_size = max(batch_size, 1)
+        self.shuffle = shuffle
+
+    def __len__(self):
         """
-        return (self.images[idx] if self.transform is None else self.transform(self.images[idx])), self.labels[idx].type(torch.LongTensor)
+        Get the number of batches.
+        :return: The number of batches including a final partial batch.
+        """
+        return (len(self.dataset) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        """
+        Iterate over the batches.
+        :return: Batches of uint8 images with augmentations applied and their labels.
+        """
+        total = len(self.dataset)
+        # Shuffle once per epoch with a single permutation rather than sampling each item.
+        order = torch.randperm(total) if self.shuffle else None
+        for start in range(0, total, self.batch_size):
+            yield self.dataset.batch(slice(start, start + self.batch_size) if order is None else order[start:start + self.batch_size])
+
+
+class ShardLoader:
+    """
+    Iterate batches from pre-augmented copies of a dataset stored as memory-mapped shards, cycling to the next shard every epoch.
+    Shards which have been used are regenerated by a background process, so augmentation is not done during training.
+    """
+
+    def __init__(self, dataset, batch_size: int, shuffle: bool, folder: str, shards: int, seed: int = None):
+        """
+        Create the shard loader, which only starts rendering shards in the background once it is first iterated.
+        :param dataset: The dataset to augment.
+        :param batch_size: The batch size.
+        :param shuffle: True to shuffle the order every time the loader is iterated, false otherwise.
+        :param folder: The folder to store the shards in.
+        :param shards: The number of augmented copies of the dataset to keep.
+        :param seed: The seed for the augmentations, or None for a random seed.
+        """
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        self.dataset = dataset
+        self.batch_size = max(batch_size, 1)
+        self.shuffle = shuffle
+        self.folder = folder
+        self.shards = max(shards, 1)
+        self.current = 0
+        self.ready = set()
+        self.seed = seed
+        self.stale = None
+        self.rendered = None
+        self.refresher = None
+
+    def start(self):
+        """
+        Start rendering every shard in the background if not already started.
+        :return: Nothing.
+        """
+        if self.refresher is not None:
+            return
+        self.dataset.images.share_memory_()
+        self.stale = torch.multiprocessing.Queue()
+        self.rendered = torch.multiprocessing.Queue()
+        self.refresher = torch.multiprocessing.Process(target=refresh_shards, args=(self.dataset.images, self.folder, self.stale, self.rendered, self.seed), daemon=True)
+        self.refresher.start()
+        for index in range(self.shards):
+            self.stale.put(index)
+
+    def __len__(self):
+        """
+        Get the number of batches.
+        :return: The number of batches including a final partial batch.
+        """
+        return (len(self.dataset) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        """
+        Iterate over the batches of the current shard, waiting for it to be rendered if needed.
+        :return: Batches of augmented uint8 images and their labels.
+        """
+        # Shards are only needed once training switches to augmented data, so rendering waits until then.
+        self.start()
+        index = self.current
+        while index not in self.ready:
+            try:
+                self.ready.add(self.rendered.get(timeout=1))
+            except queue.Empty:
+                # Without this, training would wait forever if rendering failed.
+                if not self.refresher.is_alive():
+                    raise RuntimeError(f"Shard rendering stopped with exit code {self.refresher.exitcode} before shard {index} was rendered.")
+        shard = FaceDataset(numpy.load(shard_path(self.folder, index), mmap_mode='c'), self.dataset.labels)
+        yield from BatchLoader(shard, self.batch_size, self.shuffle)
+        # Only once the whole shard has been used is it regenerated and the next shard used.
+        self.ready.discard(index)
+        self.stale.put(index)
+        self.current = (index + 1) % self.shards
+
+    def close(self):
+        """
+        Stop the background process if it was started.
+        :return: Nothing.
+        """
+        if self.refresher is None:
+            return
+        self.stale.put(None)
+        self.refresher.join()
+        self.refresher = None
+        self.ready.clear()
 
 
 class NeuralNetwork(nn.Module):
@@ -70,17 +220,33 @@ class NeuralNetwork(nn.Module):
     The neural network to train for the face dataset.
     """
 
-    def __init__(self, name: str):
+    def __init__(self, name: str, normalize: bool = False, mixed: bool = False, channels_last: bool = False, training: bool = True):
         """
         Set up the neural network loading in parameters defined in 'model_builder.py'.
+        :param name: The name of the model architecture to use.
+        :param normalize: True to standardize images with the pixel mean and standard deviation set by "set_normalization".
+        :param mixed: True to run forward passes under bfloat16 autocast, false to run in float32.
+        :param channels_last: True to store weights and run convolutions in the channels last memory format.
+        :param training: True to set up the network for training, false to only predict with weights which are loaded after, skipping the optimizer and any pretrained weights.
         """
         super().__init__()
         # Load in defined parameters.
-        self.layers = model_builder.define_layers(name)
+        self.layers = model_builder.define_layers(name, training)
         self.loss = model_builder.define_loss()
-        self.optimizer = model_builder.define_optimizer(self)
-        # Run on GPU if available.
+        self.optimizer = model_builder.define_optimizer(self) if training else None
+        # Store the normalization with the weights so saved models apply it when loaded.
+        self.normalize = normalize
+        if normalize:
+            self.register_buffer("mean", torch.tensor(0.0))
+            self.register_buffer("std", torch.tensor(1.0))
+        self.mixed = mixed
+        self.memory_format = torch.channels_last if channels_last else torch.contiguous_format
+        # Run on GPU if available, converting in place so the optimizer still references the weights.
         self.to(get_processing_device())
+        # Lazy layers such as those of ResNet have no shape until first run, so only convert the weights which exist.
+        for parameter in self.parameters():
+            if not nn.parameter.is_lazy(parameter) and parameter.dim() == 4:
+                parameter.data = parameter.data.contiguous(memory_format=self.memory_format)
 
     def forward(self, image):
         """
@@ -88,30 +254,110 @@ class NeuralNetwork(nn.Module):
         :param image: The image as a proper tensor.
         :return: The final output layer from the network.
         """
+        # Does nothing if images are already in the right format, as they are from "to_images".
+        image = image.contiguous(memory_format=self.memory_format)
+        if self.normalize:
+            image = (image - self.mean) / self.std
         return self.layers(image)
 
-    def predict(self, image):
+    def set_normalization(self, mean: float, std: float):
+        """
+        Set the pixel mean and standard deviation to standardize images with.
+        :param mean: The pixel mean of the training data.
+        :param std: The pixel standard deviation of the training data.
+        :return: Nothing.
+        """
+        self.mean.fill_(mean)
+        self.std.fill_(max(std, 1e-6))
+
+    def compile_layers(self, batch: int):
+        """
+        Compile the layers with "torch.compile" for training and inference, warming them up so the compile cost is paid up front.
+        :param batch: The batch size to warm up with.
+        :return: The time taken to compile in seconds and how many times faster compiled inference is than eager inference.
+        """
+        image = torch.rand((max(batch, 1), 1, 48, 48), device=get_processing_device())
+        label = torch.zeros(max(batch, 1), dtype=torch.long, device=get_processing_device())
+        # Warming up runs the random images through the network, so keep the buffers such as batch normalization statistics to restore after.
+        was_training = self.training
+        buffers = {name: buffer.clone() for name, buffer in self.named_buffers() if not nn.parameter.is_lazy(buffer)}
+        try:
+            self.eval()
+            eager = self.time_predict(image)
+            start = time.perf_counter()
+            # Compiling in place keeps the names of the weights, so saved models are unchanged.
+            self.layers.compile()
+            # Training and inference are compiled separately, so warm up both without stepping the optimizer.
+            if self.optimizer is not None:
+                self.train()
+                with self.precision():
+                    self.loss(self.forward(image), label).backward()
+                self.optimizer.zero_grad()
+                self.eval()
+            # Evaluating runs under inference mode on images made in inference mode, which is also compiled separately to predicting.
+            self.predict(image)
+            with torch.inference_mode():
+                self.predict(image.clone())
+            compile_time = time.perf_counter() - start
+            speedup = eager / self.time_predict(image)
+        finally:
+            with torch.no_grad():
+                for name, buffer in self.named_buffers():
+                    if name in buffers:
+                        buffer.copy_(buffers[name])
+            self.train(was_training)
+        return compile_time, speedup
+
+    def time_predict(self, image, repeats: int = 10):
+        """
+        Time how long predicting an image batch takes.
+        :param image: The image batch.
+        :param repeats: How many times to predict.
+        :return: The average time in seconds.
+        """
+        self.predict(image)
+        start = time.perf_counter()
+        for _ in range(repeats):
+            self.predict(image)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        return (time.perf_counter() - start) / repeats
+
+    def precision(self):
+        """
+        Get the context to run the network in.
+        Bfloat16 has the same range as float32, so unlike float16 no gradient scaling is needed.
+        :return: A bfloat16 autocast context if mixed precision is enabled, otherwise a disabled context.
+        """
+        return torch.autocast(get_processing_device().type, torch.bfloat16, self.mixed)
+
+    def predict(self, image, probabilities: bool = False):
         """
         Get the network's prediction for an image.
         :param image: The image as a proper tensor.
-        :return: The number the network predicts for this image.
+        :param probabilities: True to also get the probability of every expression.
+        :return: The number the network predicts for this image, and the float32 probabilities if requested.
         """
-        with torch.no_grad():
-            # Get the highest confidence output value.
-            return torch.argmax(self.forward(image), axis=-1)
+        with torch.no_grad(), self.precision():
+            output = self.forward(image)
+        # Get the highest confidence output value.
+        prediction = torch.argmax(output, axis=-1)
+        return (prediction, torch.softmax(output.float(), dim=-1)) if probabilities else prediction
 
     def optimize(self, image, label):
         """
         Optimize the neural network to fit the MNIST training data.
         :param image: The image as a proper tensor.
         :param label: The label of the image.
-        :return: The network's loss on this prediction.
+        :return: The network's loss on this prediction and how many images it predicted correctly, both as tensors on the device so reading them can be deferred.
         """
         self.optimizer.zero_grad()
-        loss = self.loss(self.forward(image), label)
+        with self.precision():
+            output = self.forward(image)
+            loss = self.loss(output, label)
         loss.backward()
         self.optimizer.step()
-        return loss.item()
+        return loss.detach(), (torch.argmax(output.detach(), axis=-1) == label).sum()
 
 
 def get_processing_device():
@@ -122,6 +368,106 @@ def get_processing_device():
     return torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
 
 
+def image_store(images):
+    """
+    Wrap parsed images as a tensor without copying them, so datasets built from the same images share one store.
+    :param images: The uint8 images parsed from the CSV of shape (N, 48, 48), or an existing store which is returned as is.
+    :return: A uint8 tensor of shape (N, 1, 48, 48) sharing memory with the images.
+    """
+    if isinstance(images, torch.Tensor):
+        return images
+    # Add a single channel for proper inputs as a view rather than a copy.
+    return torch.from_numpy(numpy.ascontiguousarray(images, dtype=numpy.uint8)).unsqueeze(1)
+
+
+def make_loader(dataset, batch: int, shuffle: bool, workers: int = 0, prefetch: int = 2, seed: int = None):
+    """
+    Create a loader for a dataset which loads whole batches either in this process or in worker processes.
+    :param dataset: The dataset to load.
+    :param batch: The batch size.
+    :param shuffle: True to shuffle the order every time the loader is iterated, false otherwise.
+    :param workers: The number of worker processes, with zero loading in this process.
+    :param prefetch: The number of batches each worker loads in advance.
+    :param seed: The seed for the order and the random stream of each worker, or None for a random seed.
+    :return: The loader.
+    """
+    if workers < 1:
+        return BatchLoader(dataset, batch, shuffle)
+    # Move the images to shared memory once so workers read them rather than each receiving a copy.
+    dataset.images.share_memory_()
+    dataset.labels.share_memory_()
+    generator = torch.Generator()
+    if seed is not None:
+        generator.manual_seed(seed)
+    sampler = RandomSampler(dataset, generator=generator) if shuffle else SequentialSampler(dataset)
+    # Each worker's random stream is seeded from the generator and its worker ID, so augmentations are reproducible.
+    return DataLoader(dataset, batch_sampler=BatchSampler(sampler, max(batch, 1), False), num_workers=workers,
+                      collate_fn=collate_batch, pin_memory=torch.cuda.is_available(), worker_init_fn=worker_init,
+                      persistent_workers=True, prefetch_factor=max(prefetch, 1), generator=generator)
+
+
+def collate_batch(batch):
+    """
+    Pass through a batch which is already built by the dataset.
+    :param batch: The images and labels.
+    :return: The images and labels.
+    """
+    return batch
+
+
+def worker_init(worker_id: int):
+    """
+    Set up a loader worker process.
+    :param worker_id: The ID of the worker.
+    :return: Nothing.
+    """
+    # Each worker augments a single batch at a time, so avoid competing with the training threads.
+    torch.set_num_threads(1)
+
+
+def shard_path(folder: str, index: int):
+    """
+    Get the path of an augmented shard.
+    :param folder: The folder the shards are stored in.
+    :param index: The index of the shard.
+    :return: The path of the shard.
+    """
+    return f"{folder}/Shard {index}.npy"
+
+
+def refresh_shards(images, folder: str, stale, rendered, seed: int = None):
+    """
+    Render augmented shards as they become stale, run in a background process by "ShardLoader".
+    :param images: The uint8 images of shape (N, 1, 48, 48) to augment.
+    :param folder: The folder to store the shards in.
+    :param stale: A queue of shard indices to render, with None to stop.
+    :param rendered: A queue to put shard indices in once they are rendered.
+    :param seed: The seed for the augmentations, or None for a random seed.
+    :return: Nothing.
+    """
+    # Rendering should not compete with the training threads.
+    torch.set_num_threads(1)
+    generator = torch.Generator()
+    if seed is not None:
+        generator.manual_seed(seed)
+    else:
+        generator.seed()
+    while True:
+        index = stale.get()
+        if index is None:
+            return
+        # Render to a temporary file and swap it in, so a shard being read is never partially written.
+        path = shard_path(folder, index)
+        temporary = f"{folder}/Shard {index} Rendering.npy"
+        shard = numpy.lib.format.open_memmap(temporary, mode="w+", dtype=numpy.uint8, shape=(len(images), 48, 48))
+        for start in range(0, len(images), 1024):
+            shard[start:start + 1024] = augmentation.augment(images[start:start + 1024], generator).squeeze(1).numpy()
+        shard.flush()
+        del shard
+        os.replace(temporary, path)
+        rendered.put(index)
+
+
 def to_tensor(tensor, device=get_processing_device()):
     """
     Convert an image to a tensor to run on the given device.
@@ -132,18 +478,29 @@ def to_tensor(tensor, device=get_processing_device()):
     return tensor.to(device)
 
 
-def dataset_details(title: str, labels):
+def to_images(images, device=get_processing_device(), memory_format=torch.contiguous_format):
+    """
+    Convert a batch of uint8 images to scaled float images to run on the given device.
+    :param images: The uint8 images.
+    :param device: The device to use for training being a CUDA GPU if available, otherwise the CPU.
+    :param memory_format: The memory format for the images, matching the network's.
+    :return: The images with all color values scaled between 0 and 1.
+    """
+    # Move before converting so only the compact uint8 pixels are transferred.
+    return images.to(device).to(dtype=torch.float32, memory_format=memory_format).div_(255)
+
+
+def dataset_details(title: str, statistics):
     """
     Output dataset details to the console.
     :param title: The title of the dataset to tell if this is the training or testing dataset.
-    :param labels: The labels.
+    :param statistics: The statistics of the dataset from "dataset_statistics".
     :return: The total count of the dataset.
     """
-    counts = [0, 0, 0, 0, 0, 0, 0]
-    for label in labels:
-        counts[label] += 1
-    total = sum(counts)
-    print(f"{title} Dataset: {total}\n"
+    counts = statistics['Counts']
+    total = max(int(counts.sum()), 1)
+    print(f"{title} Dataset: {int(counts.sum())}\n"
+          f"Pixel Mean: {statistics['Mean']:.4f}\tPixel Standard Deviation: {statistics['Std']:.4f}\n"
           f"Angry:    {counts[0]:>5}\t{counts[0] / total * 100}%\n"
           f"Disgust:  {counts[1]:>5}\t{counts[1] / total * 100}%\n"
           f"Fear:     {counts[2]:>5}\t{counts[2] / total * 100}%\n"
@@ -151,7 +508,85 @@ def dataset_details(title: str, labels):
           f"Sad:      {counts[4]:>5}\t{counts[4] / total * 100}%\n"
           f"Surprise: {counts[5]:>5}\t{counts[5] / total * 100}%\n"
           f"Neutral:  {counts[6]:>5}\t{counts[6] / total * 100}%")
-    return total
+    return int(counts.sum())
+
+
+def dataset_statistics(images, labels, chunk: int = CHUNK_ROWS):
+    """
+    Compute the class counts, pixel mean and standard deviation, and mean image of each class in one pass.
+    :param images: The uint8 images of shape (N, 48, 48).
+    :param labels: The labels.
+    :param chunk: The number of images to process at once.
+    :return: A dictionary of the class counts, pixel mean, pixel standard deviation, and class mean images, with pixels scaled between 0 and 1.
+    """
+    counts = numpy.zeros(7, dtype=numpy.int64)
+    sums = numpy.zeros((7, 48 * 48))
+    squares = 0.0
+    for start in range(0, len(labels), chunk):
+        pixels = numpy.asarray(images[start:start + chunk], dtype=numpy.float64).reshape(-1, 48 * 48) / 255
+        classes = numpy.asarray(labels[start:start + chunk])
+        counts += numpy.bincount(classes, minlength=7)
+        # Multiplying by a one-hot matrix sums the images of every class at once.
+        sums += numpy.eye(7)[classes].T @ pixels
+        squares += numpy.square(pixels).sum()
+    total = max(int(counts.sum()) * 48 * 48, 1)
+    mean = sums.sum() / total
+    return {
+        'Counts': counts,
+        'Mean': float(mean),
+        'Std': float(numpy.sqrt(max(squares / total - mean ** 2, 0))),
+        'Class Means': (sums / numpy.maximum(counts, 1)[:, None]).reshape(7, 48, 48).astype(numpy.float32)
+    }
+
+
+def load_statistics(cache: str, arrays):
+    """
+    Load the statistics of the training and testing data, computing and caching them if the cache does not have them.
+    :param cache: The folder the dataset cache is stored in, or None to not cache the statistics.
+    :param arrays: The training images, training labels, testing images, and testing labels.
+    :return: The statistics of the training and testing data.
+    """
+    fingerprint = None
+    if cache is not None and os.path.exists(f"{cache}/Fingerprint.json"):
+        try:
+            with open(f"{cache}/Fingerprint.json", "r") as file:
+                fingerprint = json.load(file).get('Hash')
+        except (OSError, ValueError):
+            fingerprint = None
+    # Statistics are only valid for the dataset cache with the same hash.
+    if fingerprint is not None and os.path.exists(f"{cache}/Statistics.npz"):
+        try:
+            with numpy.load(f"{cache}/Statistics.npz") as stored:
+                if str(stored['Hash']) == fingerprint:
+                    return tuple({key: (stored[f"{split} {key}"] if key in ['Counts', 'Class Means'] else float(stored[f"{split} {key}"])) for key in STATISTICS} for split in ["Train", "Test"])
+        except (OSError, ValueError, KeyError):
+            pass
+    statistics = dataset_statistics(arrays[0], arrays[1]), dataset_statistics(arrays[2], arrays[3])
+    if fingerprint is not None:
+        numpy.savez(f"{cache}/Statistics.npz", Hash=fingerprint, **{f"{split} {key}": values[key] for split, values in zip(["Train", "Test"], statistics) for key in STATISTICS})
+    return statistics
+
+
+def memory_details(datasets):
+    """
+    Output how much memory the datasets use to the console.
+    :param datasets: The datasets.
+    :return: The number of bytes the datasets use.
+    """
+    storages = {}
+    separate = 0
+    for dataset in datasets:
+        for tensor in [dataset.images, dataset.labels]:
+            storage = tensor.untyped_storage()
+            storages[storage.data_ptr()] = storage.nbytes()
+            separate += tensor.numel() * tensor.element_size()
+    shared = sum(storages.values())
+    # Each dataset previously held its own float32 copy of the images.
+    legacy = sum(dataset.images.numel() * 4 + dataset.labels.numel() * 4 for dataset in datasets)
+    print(f"Dataset Memory: {shared / 1e6:.2f} MB shared across {len(datasets)} datasets\n"
+          f"Separate Copies: {separate / 1e6:.2f} MB\n"
+          f"Separate Float32 Copies: {legacy / 1e6:.2f} MB")
+    return shared
 
 
 def data_image(dataloader, name: str, title: str):
@@ -162,46 +597,414 @@ def data_image(dataloader, name: str, title: str):
     :param title: The title to give the image.
     :return: Nothing.
     """
-    torchvision.utils.save_image(torchvision.utils.make_grid(iter(dataloader).__next__()[0]), f"{os.getcwd()}/Models/{name}/{title}.png")
+    torchvision.utils.save_image(torchvision.utils.make_grid(to_images(iter(dataloader).__next__()[0], torch.device("cpu"))), f"{os.getcwd()}/Models/{name}/{title}.png")
+
+
+def synchronize():
+    """
+    Wait for all queued work on the processing device to finish so it can be timed.
+    :return: Nothing.
+    """
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
 
 
-def test(model, batch: int, dataloader):
+def evaluate(model, dataloader):
     """
-    Test a neural network.
+    Evaluate a neural network over every image of a dataloader once.
     :param model: The neural network.
-    :param batch: The batch size.
-    :param dataloader: The dataloader to test.
-    :return: The model's accuracy.
+    :param dataloader: The dataloader to evaluate, which should not shuffle so results are deterministic.
+    :return: The accuracy, the accuracy of each expression, the confusion matrix with a row for each label and a column for each prediction, the time spent predicting in seconds, and the time spent loading in seconds.
     """
-    # Count how many are correct.
-    correct = 0
-    # Loop through all data.
-    for raw_image, raw_label in dataloader:
-        image, label = to_tensor(raw_image), to_tensor(raw_label)
-        # If properly predicted, count it as correct.
-        correct += (label == model.predict(image)).sum()
-    # Calculate the overall accuracy.
-    return correct / (len(dataloader) * batch) * 100
+    classes = len(EXPRESSIONS)
+    compute_time = 0
+    load_time = 0
+    # Dropout and batch normalization must not use or change anything from the evaluation data.
+    was_training = model.training
+    model.eval()
+    try:
+        with torch.inference_mode():
+            # Count every label and prediction pair on the device so nothing is read back until the end.
+            confusion = torch.zeros(classes * classes, dtype=torch.long, device=get_processing_device())
+            batches = iter(dataloader)
+            while True:
+                start = time.perf_counter()
+                try:
+                    raw_image, raw_label = next(batches)
+                except StopIteration:
+                    break
+                image, label = to_images(raw_image, memory_format=model.memory_format), to_tensor(raw_label)
+                synchronize()
+                loaded = time.perf_counter()
+                confusion += torch.bincount(label * classes + model.predict(image), minlength=classes * classes)
+                synchronize()
+                compute_time += time.perf_counter() - loaded
+                load_time += loaded - start
+    finally:
+        model.train(was_training)
+    confusion = confusion.view(classes, classes).cpu()
+    correct = confusion.diagonal()
+    # Count exactly how many images there were so a final partial batch is not miscounted.
+    accuracy = correct.sum().item() / max(confusion.sum().item(), 1) * 100
+    class_accuracy = (correct / confusion.sum(dim=1).clamp(min=1) * 100).tolist()
+    return accuracy, class_accuracy, confusion.numpy(), compute_time, load_time
 
 
-def prepare_data(data):
+def benchmark_inference(model, batches, threads, warmup: int = 10, repeats: int = 100):
+    """
+    Measure the latency and throughput of a neural network predicting batches of different sizes with different numbers of threads.
+    :param model: The neural network.
+    :param batches: The batch sizes to measure.
+    :param threads: The numbers of threads to measure.
+    :param warmup: The number of predictions to make before timing so caches and lazy initialization do not affect results.
+    :param repeats: The number of predictions to time.
+    :return: The results of each batch size and number of threads.
+    """
+    original = torch.get_num_threads()
+    results = []
+    try:
+        for thread in threads:
+            torch.set_num_threads(thread)
+            for batch in batches:
+                # Time only the prediction itself, so the images are already on the device.
+                image = to_images(torch.randint(0, 256, (batch, 1, 48, 48), dtype=torch.uint8), memory_format=model.memory_format)
+                for _ in range(warmup):
+                    model.predict(image)
+                synchronize()
+                latencies = []
+                for _ in range(repeats):
+                    start = time.perf_counter()
+                    model.predict(image)
+                    synchronize()
+                    latencies.append((time.perf_counter() - start) * 1000)
+                p50, p95, p99 = numpy.percentile(latencies, [50, 95, 99])
+                results.append({
+                    'Batch': batch,
+                    'Threads': thread,
+                    'P50 Latency (ms)': float(p50),
+                    'P95 Latency (ms)': float(p95),
+                    'P99 Latency (ms)': float(p99),
+                    'Images Per Second': float(batch * repeats / (sum(latencies) / 1000))
+                })
+                print(f"Batch {batch:>4} | Threads {thread:>3} | P50 {p50:.3f} ms | P95 {p95:.3f} ms | P99 {p99:.3f} ms | {results[-1]['Images Per Second']:.0f} images/s")
+    finally:
+        torch.set_num_threads(original)
+    return results
+
+
+def evaluation_details(evaluation):
+    """
+    Format the results of an evaluation.
+    :param evaluation: The results from "evaluate".
+    :return: The accuracy of each expression, the average time to predict and load each image, and the confusion matrix.
+    """
+    accuracy, class_accuracy, confusion, compute_time, load_time = evaluation
+    total = max(int(confusion.sum()), 1)
+    details = "".join(f"{expression + ' Accuracy:':<19}{class_accuracy[i]}\n" for i, expression in enumerate(EXPRESSIONS))
+    details += (f"Average Inference Time: {compute_time / total * 1000} ms\n"
+                f"Average Loading Time: {load_time / total * 1000} ms\n"
+                f"Confusion Matrix (Rows Labels, Columns Predictions):\n"
+                f"{'':<9}" + "".join(f"{expression:>9}" for expression in EXPRESSIONS))
+    for i, expression in enumerate(EXPRESSIONS):
+        details += f"\n{expression:<9}" + "".join(f"{int(count):>9}" for count in confusion[i])
+    return details
+
+
+def parse_pixels(pixels):
+    """
+    Convert a column of raw pixel data strings into images in a single pass.
+    :param pixels: The pixel data strings, each being 2304 space separated values.
+    :return: The images as a uint8 array of shape (N, 48, 48).
+    """
+    pixels = list(pixels)
+    if len(pixels) == 0:
+        return numpy.zeros(shape=(0, 48, 48), dtype=numpy.uint8)
+    # Join every string into one buffer so it can be parsed at once rather than row by row.
+    # Parse into a wider type first, as parsing straight to uint8 silently wraps values which are out of range.
+    images = numpy.fromstring(" ".join(pixels), dtype=numpy.int64, sep=' ')
+    if images.size != len(pixels) * 48 * 48:
+        raise ValueError(f"Pixel data does not contain 48x48 images, got {images.size} values for {len(pixels)} rows.")
+    if images.min() < 0 or images.max() > 255:
+        raise ValueError(f"Pixel values must be between 0 and 255, got values between {images.min()} and {images.max()}.")
+    return images.astype(numpy.uint8).reshape((len(pixels), 48, 48))
+
+
+def parse_data(data):
     """
-    Convert the raw pixel data strings for use with PyTorch.
+    Convert the raw pixel data strings into compact images and labels.
     :param data: The data frame loaded from the CSV with emotions and pixel data.
-    :return: Images and labels ready for PyTorch.
-    """
-    images = numpy.zeros(shape=(len(data), 48, 48))
-    labels = numpy.array(list(map(int, data['emotion'])))
-    # Break apart the string and resize it as a 48x48 image.
-    for i, row in enumerate(data.index):
-        image = numpy.fromstring(data.loc[row, 'pixels'], dtype=int, sep=' ')
-        image = numpy.reshape(image, (48, 48))
-        images[i] = image
+    :return: The images as uint8 values of shape (N, 48, 48) and the labels as int64 values.
+    """
+    return parse_pixels(data['pixels']), data['emotion'].to_numpy(dtype=numpy.int64)
+
+
+def scale_images(images):
+    """
+    Scale parsed uint8 images for use with PyTorch.
+    :param images: The uint8 images of shape (N, 48, 48).
+    :return: The images as float32 values between 0 and 1 of shape (N, 48, 48, 1).
+    """
     # Ensure single channel added for proper inputs.
     images = images.reshape((images.shape[0], 48, 48, 1))
     # Scale all color values between 0 and 1.
-    images = images.astype('float32') / 255
-    return images, labels
+    return images.astype('float32') / 255
+
+
+def prepare_data(data):
+    """
+    Convert the raw pixel data strings to float images, "FaceDataset" instead takes the compact output of "parse_data".
+    :param data: The data frame loaded from the CSV with emotions and pixel data.
+    :return: Float32 images scaled between 0 and 1 of shape (N, 48, 48, 1) and labels.
+    """
+    images, labels = parse_data(data)
+    return scale_images(images), labels
+
+
+def data_fingerprint(path: str, hashed: bool = True):
+    """
+    Get a fingerprint of a file to tell if it has changed.
+    :param path: The path of the file.
+    :param hashed: True to include a hash of the file contents, false to only use its size and modified time.
+    :return: A dictionary with the size, modified time, and optionally the hash of the file.
+    """
+    stat = os.stat(path)
+    fingerprint = {'Size': stat.st_size, 'Modified': stat.st_mtime_ns}
+    if hashed:
+        digest = hashlib.sha256()
+        with open(path, "rb") as file:
+            for block in iter(lambda: file.read(1 << 20), b""):
+                digest.update(block)
+        fingerprint['Hash'] = digest.hexdigest()
+    return fingerprint
+
+
+def load_cache(path: str, cache: str):
+    """
+    Load the cached dataset if the CSV it was built from has not changed.
+    :param path: The path of the CSV.
+    :param cache: The folder the cache is stored in.
+    :return: Memory-mapped training images, training labels, testing images, and testing labels, or None if the cache is missing or stale.
+    """
+    if not os.path.exists(f"{cache}/Fingerprint.json"):
+        return None
+    try:
+        with open(f"{cache}/Fingerprint.json", "r") as file:
+            stored = json.load(file)
+    except (OSError, ValueError):
+        return None
+    fingerprint = data_fingerprint(path, False)
+    if fingerprint['Size'] != stored.get('Size'):
+        return None
+    # Only hash the file when its modified time changed, otherwise the size and time are enough.
+    if fingerprint['Modified'] != stored.get('Modified'):
+        fingerprint = data_fingerprint(path)
+        if fingerprint['Hash'] != stored.get('Hash'):
+            return None
+        # Contents are the same, so store the new time to skip hashing next time.
+        stored['Modified'] = fingerprint['Modified']
+        with open(f"{cache}/Fingerprint.json", "w") as file:
+            json.dump(stored, file)
+    try:
+        return tuple(numpy.load(f"{cache}/{name}.npy", mmap_mode='c') for name in CACHE_FILES)
+    except (OSError, ValueError):
+        return None
+
+
+def write_cache(path: str, cache: str, arrays):
+    """
+    Write the parsed dataset to the cache.
+    :param path: The path of the CSV the dataset was parsed from.
+    :param cache: The folder to store the cache in.
+    :param arrays: The training images, training labels, testing images, and testing labels.
+    :return: Nothing.
+    """
+    if not os.path.exists(cache):
+        os.mkdir(cache)
+    # Remove the old fingerprint first so a partially written cache is never treated as valid.
+    if os.path.exists(f"{cache}/Fingerprint.json"):
+        os.remove(f"{cache}/Fingerprint.json")
+    # The arrays can differ even when the CSV has not changed, such as with a different deduplication distance, so the statistics are recomputed.
+    if os.path.exists(f"{cache}/Statistics.npz"):
+        os.remove(f"{cache}/Statistics.npz")
+    for name, array in zip(CACHE_FILES, arrays):
+        numpy.save(f"{cache}/{name}.npy", numpy.ascontiguousarray(array))
+    with open(f"{cache}/Fingerprint.json", "w") as file:
+        json.dump(data_fingerprint(path), file)
+
+
+def npy_header(shape, dtype):
+    """
+    Build a fixed size ".npy" header so it can be rewritten in place once the final shape is known.
+    :param shape: The shape of the array.
+    :param dtype: The data type of the array.
+    :return: The header bytes.
+    """
+    header = str({'descr': numpy.lib.format.dtype_to_descr(numpy.dtype(dtype)), 'fortran_order': False, 'shape': tuple(shape)})
+    # Pad with spaces so the magic string, version, length, and header add up to the fixed size.
+    header = header.ljust(NPY_HEADER - 11) + "\n"
+    return numpy.lib.format.MAGIC_PREFIX + b"\x01\x00" + len(header).to_bytes(2, "little") + header.encode("latin1")
+
+
+def stream_cache(path: str, cache: str, chunk: int = CHUNK_ROWS):
+    """
+    Parse the CSV in chunks, appending each split straight to the cache so memory use does not grow with the file size.
+    :param path: The path of the CSV.
+    :param cache: The folder to store the cache in.
+    :param chunk: The number of rows to parse at once.
+    :return: Memory-mapped training images, training labels, testing images, and testing labels.
+    """
+    if not os.path.exists(cache):
+        os.mkdir(cache)
+    # Remove the old fingerprint first so a partially written cache is never treated as valid.
+    if os.path.exists(f"{cache}/Fingerprint.json"):
+        os.remove(f"{cache}/Fingerprint.json")
+    files = [open(f"{cache}/{name}.npy", "wb") for name in CACHE_FILES]
+    counts = [0, 0]
+    try:
+        for file in files:
+            file.write(b"\0" * NPY_HEADER)
+        for data in pandas.read_csv(path, chunksize=chunk):
+            training = (data['Usage'] == 'Training').to_numpy()
+            for split, mask in enumerate([training, ~training]):
+                images, labels = parse_data(data[mask])
+                files[split * 2].write(images.tobytes())
+                files[split * 2 + 1].write(labels.tobytes())
+                counts[split] += len(labels)
+        # Now the sizes are known, fill in the headers.
+        for split in range(2):
+            files[split * 2].seek(0)
+            files[split * 2].write(npy_header((counts[split], 48, 48), numpy.uint8))
+            files[split * 2 + 1].seek(0)
+            files[split * 2 + 1].write(npy_header((counts[split],), numpy.int64))
+    finally:
+        for file in files:
+            file.close()
+    with open(f"{cache}/Fingerprint.json", "w") as file:
+        json.dump(data_fingerprint(path), file)
+    return tuple(numpy.load(f"{cache}/{name}.npy", mmap_mode='c') for name in CACHE_FILES)
+
+
+def csv_ranges(path: str, parts: int):
+    """
+    Split a CSV into byte ranges which start and end on line boundaries, excluding the header.
+    :param path: The path of the CSV.
+    :param parts: The minimum number of ranges to split into, more are used so ranges are no larger than "RANGE_BYTES" apart from finishing their last line.
+    :return: The column names and a list of the start and end byte of each range.
+    """
+    size = os.path.getsize(path)
+    with open(path, "rb") as file:
+        columns = file.readline().decode().strip().split(",")
+        header = file.tell()
+        start = header
+        parts = max(parts, (size - header + RANGE_BYTES - 1) // RANGE_BYTES, 1)
+        ranges = []
+        for part in range(1, parts + 1):
+            # Split evenly from the end of the header, moving each split point forward to the end of the line it lands in.
+            end = size
+            if part < parts:
+                file.seek(max(header + (size - header) * part // parts - 1, start))
+                file.readline()
+                end = file.tell()
+            if end > start:
+                ranges.append((start, end))
+            start = end
+    return columns, ranges
+
+
+def read_range(path: str, columns, start: int, end: int, usecols=None):
+    """
+    Read a byte range of a CSV into a data frame.
+    :param path: The path of the CSV.
+    :param columns: The column names of the CSV.
+    :param start: The first byte of the range.
+    :param end: The byte after the end of the range.
+    :param usecols: The columns to read, or None to read all columns.
+    :return: The data frame.
+    """
+    with open(path, "rb") as file:
+        file.seek(start)
+        return pandas.read_csv(io.BytesIO(file.read(end - start)), header=None, names=columns, usecols=usecols)
+
+
+def count_range(task):
+    """
+    Count how many rows in a byte range of a CSV belong to each split, run by worker processes.
+    :param task: The path of the CSV, the column names, and the start and end byte of the range.
+    :return: The number of training and testing rows.
+    """
+    path, columns, start, end = task
+    usage = read_range(path, columns, start, end, ['Usage'])['Usage']
+    training = int((usage == 'Training').sum())
+    return training, len(usage) - training
+
+
+def parse_range(task):
+    """
+    Parse a byte range of a CSV straight into the memory-mapped cache, run by worker processes.
+    :param task: The path of the CSV, the column names, the start and end byte of the range, the cache folder, and the first training and testing row to write to.
+    :return: Nothing.
+    """
+    path, columns, start, end, cache, offsets = task
+    data = read_range(path, columns, start, end)
+    training = (data['Usage'] == 'Training').to_numpy()
+    for split, mask in enumerate([training, ~training]):
+        images, labels = parse_data(data[mask])
+        cached_images = numpy.load(f"{cache}/{CACHE_FILES[split * 2]}.npy", mmap_mode='r+')
+        cached_labels = numpy.load(f"{cache}/{CACHE_FILES[split * 2 + 1]}.npy", mmap_mode='r+')
+        cached_images[offsets[split]:offsets[split] + len(labels)] = images
+        cached_labels[offsets[split]:offsets[split] + len(labels)] = labels
+        cached_images.flush()
+        cached_labels.flush()
+
+
+def parallel_cache(path: str, cache: str, workers: int):
+    """
+    Parse the CSV with a pool of processes which each write their rows straight into the cache.
+    :param path: The path of the CSV.
+    :param cache: The folder to store the cache in.
+    :param workers: The number of processes.
+    :return: Memory-mapped training images, training labels, testing images, and testing labels.
+    """
+    if not os.path.exists(cache):
+        os.mkdir(cache)
+    # Remove the old fingerprint first so a partially written cache is never treated as valid.
+    if os.path.exists(f"{cache}/Fingerprint.json"):
+        os.remove(f"{cache}/Fingerprint.json")
+    columns, ranges = csv_ranges(path, workers * 4)
+    with multiprocessing.Pool(workers) as pool:
+        # Count the rows of each split in every range first so each range knows where to write.
+        counts = pool.map(count_range, [(path, columns, start, end) for start, end in ranges])
+        totals = numpy.sum(counts, axis=0, dtype=numpy.int64) if counts else numpy.zeros(2, dtype=numpy.int64)
+        offsets = numpy.cumsum([[0, 0]] + counts[:-1], axis=0)
+        for split in range(2):
+            numpy.lib.format.open_memmap(f"{cache}/{CACHE_FILES[split * 2]}.npy", mode="w+", dtype=numpy.uint8, shape=(int(totals[split]), 48, 48)).flush()
+            numpy.lib.format.open_memmap(f"{cache}/{CACHE_FILES[split * 2 + 1]}.npy", mode="w+", dtype=numpy.int64, shape=(int(totals[split]),)).flush()
+        pool.map(parse_range, [(path, columns, start, end, cache, tuple(int(offset) for offset in offset_pair)) for (start, end), offset_pair in zip(ranges, offsets)])
+    with open(f"{cache}/Fingerprint.json", "w") as file:
+        json.dump(data_fingerprint(path), file)
+    return tuple(numpy.load(f"{cache}/{name}.npy", mmap_mode='c') for name in CACHE_FILES)
+
+
+def load_data(path: str, cache: str = None, rebuild: bool = False, workers: int = 1):
+    """
+    Load the training and testing data, using the cache when possible.
+    :param path: The path of the CSV.
+    :param cache: The folder to cache the parsed dataset in, or None to parse it into memory.
+    :param rebuild: True to parse the CSV even if the cache is valid.
+    :param workers: The number of processes to parse the CSV with when building the cache.
+    :return: Training images, training labels, testing images, and testing labels as uint8 images and int64 labels.
+    """
+    if cache is not None:
+        if not rebuild:
+            cached = load_cache(path, cache)
+            if cached is not None:
+                return cached
+        return parallel_cache(path, cache, workers) if workers > 1 else stream_cache(path, cache)
+    df = pandas.read_csv(path)
+    train_images, train_labels = parse_data(df[df['Usage'] == 'Training'])
+    test_images, test_labels = parse_data(df[df['Usage'] != 'Training'])
+    return train_images, train_labels, test_images, test_labels
+
 
 def save(name: str, model, best_model, epoch: int, no_change: int, best_accuracy: float, loss: float, augmented: bool):
     torch.save({
@@ -216,18 +1019,148 @@ def save(name: str, model, best_model, epoch: int, no_change: int, best_accuracy
     }, f"{os.getcwd()}/Models/{name}/Model.pt")
 
 
-def write_parameters(name: str, best_accuracy: float, train_accuracy: float, inference_time: float, trainable_parameters: int, best_epoch: int, augmented: bool):
+def compile_network(model, batch: int):
+    """
+    Compile a network, caching the compiled artifacts so later runs compile faster.
+    :param model: The neural network.
+    :param batch: The batch size.
+    :return: The time taken to compile in seconds and how many times faster compiled inference is than eager inference.
+    """
+    os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", f"{os.getcwd()}/Cache/Compiled")
+    print("Compiling model...")
+    compile_time, speedup = model.compile_layers(batch)
+    print(f"Compiled in {compile_time:.2f} s with {speedup:.2f}x faster inference.")
+    return compile_time, speedup
+
+
+def write_parameters(name: str, evaluation, train_accuracy: float, trainable_parameters: int, best_epoch: int, augmented: bool, compiled=None):
     parameters = open(f"{os.getcwd()}/Models/{name}/Details.txt", "w")
-    parameters.write(f"Testing Accuracy: {best_accuracy}\n"
+    parameters.write(f"Testing Accuracy: {evaluation[0]}\n"
                      f"Training Accuracy: {train_accuracy}\n"
-                     f"Average Inference Time: {inference_time} ms\n"
                      f"Trainable Parameters: {trainable_parameters}\n"
                      f"Best Epoch: {best_epoch}\n"
-                     f"Augmented: {augmented}")
+                     f"Augmented: {augmented}\n"
+                     f"{evaluation_details(evaluation)}")
+    if compiled is not None:
+        parameters.write(f"\nCompile Time: {compiled[0]} s\n"
+                         f"Compiled Inference Speedup: {compiled[1]}x")
     parameters.close()
 
 
-def main(name: str, epochs: int, batch: int, load: bool, wait: int):
+def model_name(name: str):
+    """
+    Get the name a model architecture is saved under.
+    :param name: The name of the model architecture in any case.
+    :return: The name of the model architecture.
+    """
+    name = name.lower()
+    if name == "simple":
+        return "Simple"
+    if name == "expanded":
+        return "Expanded"
+    if name == "resnet":
+        return "ResNet"
+    raise ValueError(f"Model architecture \"{name}\" does not exist, options are \"simple\", \"expanded\", or \"resnet\".")
+
+
+def model_exists(name: str):
+    """
+    Check if a model has been trained or exported.
+    :param name: The name of the model.
+    :return: True if the model has been trained or exported, false otherwise.
+    """
+    return os.path.exists(f"{os.getcwd()}/Models/{name}/Model.pt") or os.path.exists(f"{os.getcwd()}/Models/{name}/Inference.pt")
+
+
+def load_model(name: str, mixed: bool = False, channels_last: bool = False):
+    """
+    Load the best weights of a trained model to predict with, using the exported inference weights unless the model has been trained since.
+    :param name: The name of the model.
+    :param mixed: True to predict with bfloat16 mixed precision.
+    :param channels_last: True to run the model and its inputs in the channels last memory format.
+    :return: The model in evaluation mode, or None if it could not be loaded.
+    """
+    training = f"{os.getcwd()}/Models/{name}/Model.pt"
+    inference = f"{os.getcwd()}/Models/{name}/Inference.pt"
+    if not model_exists(name):
+        print(f"Model '{name}' does not exist to load.")
+        return None
+    try:
+        if os.path.exists(inference) and (not os.path.exists(training) or os.path.getmtime(inference) >= os.path.getmtime(training)):
+            # Memory map the weights so they are read straight into the model rather than copied.
+            saved = torch.load(inference, mmap=True, weights_only=True)
+            model = NeuralNetwork(name, saved['Normalize'], mixed, channels_last, False)
+            model.load_state_dict(saved['Weights'])
+        else:
+            saved = torch.load(training)
+            model = NeuralNetwork(name, 'mean' in saved['Best'], mixed, channels_last, False)
+            model.load_state_dict(saved['Best'])
+    except:
+        print("Model to load has different structure than 'model_builder'.py, cannot load.")
+        return None
+    # Loaded models are only used to predict, so dropout and batch normalization are set for inference.
+    model.eval()
+    return model
+
+
+def export(name: str, half: bool):
+    """
+    Export the best weights of a trained model to "Inference.pt" in its folder, which loads faster as it has nothing needed only for training.
+    :param name: The name of the model.
+    :param half: True to store the weights in half precision, halving the size.
+    :return: Nothing.
+    """
+    training = f"{os.getcwd()}/Models/{name}/Model.pt"
+    if not os.path.exists(training):
+        print(f"Model '{name}' does not exist to export.")
+        return
+    weights = torch.load(training, map_location="cpu")['Best']
+    if half:
+        weights = {key: value.half() if value.is_floating_point() else value for key, value in weights.items()}
+    torch.save({
+        'Normalize': 'mean' in weights,
+        'Half': half,
+        'Weights': weights
+    }, f"{os.getcwd()}/Models/{name}/Inference.pt")
+    print(f"Exported '{name}' from {os.path.getsize(training) / 1e6:.2f} MB to {os.path.getsize(f'{os.getcwd()}/Models/{name}/Inference.pt') / 1e6:.2f} MB.")
+
+
+def main_benchmark(name: str, mixed: bool, compile_model: bool, channels_last: bool):
+    """
+    Benchmark the inference latency and throughput of a model, writing the results to "Benchmark.json" in its folder.
+    :param name: The name of the model.
+    :param mixed: True to predict with bfloat16 mixed precision.
+    :param compile_model: True to compile the model with "torch.compile".
+    :param channels_last: True to run the model and its inputs in the channels last memory format.
+    :return: Nothing.
+    """
+    # Use the best weights if the model has been trained, otherwise newly initialized weights perform the same.
+    if model_exists(name):
+        model = load_model(name, mixed, channels_last)
+        if model is None:
+            return
+        print(f"Benchmarking the best weights of '{name}'.")
+    else:
+        model = NeuralNetwork(name, mixed=mixed, channels_last=channels_last, training=False)
+        print(f"Model '{name}' does not exist, benchmarking newly initialized weights.")
+    model.eval()
+    compiled = compile_network(model, BENCHMARK_BATCHES[-1]) if compile_model else None
+    # Double the threads up to every available thread.
+    threads = sorted({min(2 ** i, torch.get_num_threads()) for i in range(torch.get_num_threads().bit_length() + 1)})
+    results = benchmark_inference(model, BENCHMARK_BATCHES, threads)
+    if not os.path.exists(f"{os.getcwd()}/Models/{name}"):
+        os.makedirs(f"{os.getcwd()}/Models/{name}")
+    with open(f"{os.getcwd()}/Models/{name}/Benchmark.json", "w") as file:
+        json.dump({
+            'Device': get_processing_device().type,
+            'Mixed': mixed,
+            'Compiled': compiled is not None,
+            'Channels Last': channels_last,
+            'Results': results
+        }, file, indent=4)
+
+
+def main(name: str, epochs: int, batch: int, load: bool, wait: int, rebuild: bool, workers: int, prefetch: int, seed: int, shards: int, normalize: bool, deduplicated: bool, mixed: bool, compile_model: bool, channels_last: bool, interval: int, exact: bool, eval_batch: int, benchmark: bool, export_model: bool, half: bool):
     """
     Main program execution.
     :param name: The name of the model to save files under.
@@ -235,59 +1168,89 @@ def main(name: str, epochs: int, batch: int, load: bool, wait: int):
     :param batch: The batch size.
     :param load: Whether to load an existing model or train a new one.
     :param wait: The number of epochs to wait before switching to augmented data if there are no network improvements.
+    :param rebuild: True to rebuild the dataset cache even if "Data.csv" has not changed.
+    :param workers: The number of worker processes to parse and load data with, with zero loading in the main process.
+    :param prefetch: The number of batches each worker loads in advance.
+    :param seed: The random seed, or None for a random seed.
+    :param shards: The number of pre-augmented copies of the training data to cycle through, with zero augmenting during training.
+    :param normalize: True to standardize images with the pixel mean and standard deviation of the training data.
+    :param deduplicated: True to use the deduplicated dataset built by "deduplicate.py".
+    :param mixed: True to train and test with bfloat16 mixed precision.
+    :param compile_model: True to compile the model with "torch.compile".
+    :param channels_last: True to run the model and its inputs in the channels last memory format.
+    :param interval: The number of batches between showing the running loss and accuracy, with zero only reading them at the end of each epoch.
+    :param exact: True to measure the training accuracy with a separate pass over the unchanged training data rather than during training.
+    :param eval_batch: The batch size for evaluating.
+    :param benchmark: True to benchmark the inference latency and throughput of the model rather than training it.
+    :param export_model: True to export the best weights of the model for inference rather than training it.
+    :param half: True to export the weights in half precision.
     :return: Nothing.
     """
     print(f"Face Expression Recognition Deep Learning")
     print(f"Running on GPU with CUDA {torch.version.cuda}." if torch.cuda.is_available() else "Running on CPU.")
+    name = model_name(name)
+    if seed is not None:
+        torch.manual_seed(seed)
+    # Export and benchmark inference without needing any data.
+    if export_model:
+        export(name, half)
+        return
+    if benchmark:
+        main_benchmark(name, mixed, compile_model, channels_last)
+        return
     if not os.path.exists(f"{os.getcwd()}/Data.csv"):
         print("Data.csv missing, visit https://github.com/StevenRice99/COMP-4730-Project-2#setup for instructions.")
         return
-    name = name.lower()
-    if name == "simple":
-        name = "Simple"
-    elif name == "expanded":
-        name = "Expanded"
-    elif name == "resnet":
-        name = "ResNet"
-    else:
-        raise ValueError(f"Model architecture \"{name}\" does not exist, options are \"simple\", \"expanded\", or \"resnet\".")
     # Setup datasets.
     print("Loading data...")
-    df = pandas.read_csv(f"{os.getcwd()}/Data.csv")
-    train_images, train_labels = prepare_data(df[df['Usage'] == 'Training'])
-    test_images, test_labels = prepare_data(df[df['Usage'] != 'Training'])
+    if deduplicated:
+        arrays = load_cache(f"{os.getcwd()}/Data.csv", f"{os.getcwd()}/Cache/Deduplicated")
+        if arrays is None:
+            print("Deduplicated dataset missing or out of date, run \"deduplicate.py\" first.")
+            return
+        train_statistics, test_statistics = load_statistics(f"{os.getcwd()}/Cache/Deduplicated", arrays)
+    else:
+        arrays = load_data(f"{os.getcwd()}/Data.csv", f"{os.getcwd()}/Cache", rebuild, workers)
+        train_statistics, test_statistics = load_statistics(f"{os.getcwd()}/Cache", arrays)
+    train_images, train_labels, test_images, test_labels = arrays
+    # Build one store for each split which every dataset views, augmentation is applied per item rather than copied.
+    train_images, test_images = image_store(train_images), image_store(test_images)
+    train_labels, test_labels = torch.as_tensor(train_labels), torch.as_tensor(test_labels)
     normal_training_data = FaceDataset(train_images, train_labels)
     augmented_training_data = FaceDataset(train_images, train_labels, True)
     testing_data = FaceDataset(test_images, test_labels)
-    training_total = dataset_details("Training", train_labels)
-    testing_total = dataset_details("Testing", test_labels)
-    normal_training = DataLoader(normal_training_data, batch_size=batch, shuffle=True)
-    augmented_training = DataLoader(augmented_training_data, batch_size=batch, shuffle=True)
-    testing = DataLoader(testing_data, batch_size=batch, shuffle=True)
+    dataset_details("Training", train_statistics)
+    training_total = len(train_labels)
+    dataset_details("Testing", test_statistics)
+    memory_details([normal_training_data, augmented_training_data, testing_data])
+    eval_batch = max(eval_batch, 1)
+    # Evaluate in a fixed order with a separate batch size, as large batches are faster when no gradients are needed.
+    testing = make_loader(testing_data, eval_batch, False, workers, prefetch)
+    training_evaluation = make_loader(normal_training_data, eval_batch, False, workers, prefetch) if load or exact else None
     # Load a model if flagged to do so.
     if load:
         # If a model does not exist to load decide to generate a new model instead.
-        if not os.path.exists(f"{os.getcwd()}/Models/{name}/Model.pt"):
-            print(f"Model '{name}' does not exist to load.")
+        model = load_model(name, mixed, channels_last)
+        if model is None:
             return
-        try:
-            model = NeuralNetwork(name)
-            saved = torch.load(f"{os.getcwd()}/Models/{name}/Model.pt")
-            model.load_state_dict(saved['Best'])
-        except:
-            print("Model to load has different structure than 'model_builder'.py, cannot load.")
-            return
-        train_accuracy = test(model, batch, normal_training)
-        start = time.time_ns()
-        accuracy = test(model, batch, testing)
-        end = time.time_ns()
-        inference_time = ((end - start) / testing_total) / 1e+6
-        print(f"Testing Accuracy = {accuracy}%\n"
+        if compile_model:
+            compile_network(model, batch)
+        train_accuracy = evaluate(model, training_evaluation)[0]
+        evaluation = evaluate(model, testing)
+        print(f"Testing Accuracy = {evaluation[0]}%\n"
               f"Training Accuracy = {train_accuracy}%\n"
-              f"Average Inference Time: {inference_time} ms")
+              f"{evaluation_details(evaluation)}")
         return
     # Otherwise, train a model.
-    model = NeuralNetwork(name)
+    # Offset the seed for each loader so they do not share the same random streams.
+    normal_training = make_loader(normal_training_data, batch, True, workers, prefetch, None if seed is None else seed + 1)
+    if shards > 0:
+        augmented_training = ShardLoader(augmented_training_data, batch, True, f"{os.getcwd()}/Cache/Shards/{name}", shards, None if seed is None else seed + 2)
+    else:
+        augmented_training = make_loader(augmented_training_data, batch, True, workers, prefetch, None if seed is None else seed + 2)
+    model = NeuralNetwork(name, normalize, mixed, channels_last)
+    if normalize:
+        model.set_normalization(train_statistics['Mean'], train_statistics['Std'])
     best_model = model.state_dict()
     summary(model, input_size=(1, 48, 48))
     if batch < 1:
@@ -320,13 +1283,13 @@ def main(name: str, epochs: int, batch: int, load: bool, wait: int):
         os.mkdir(f"{os.getcwd()}/Models")
     if not os.path.exists(f"{os.getcwd()}/Models/{name}"):
         os.mkdir(f"{os.getcwd()}/Models/{name}")
-    start = time.time_ns()
-    accuracy = test(model, batch, testing)
-    end = time.time_ns()
-    inference_time = ((end - start) / testing_total) / 1e+6
-    # Generate sample images of the data.
-    data_image(augmented_training, name, 'Sample Augmented')
-    data_image(testing, name, 'Sample Unchanged')
+    evaluation = evaluate(model, testing)
+    accuracy = evaluation[0]
+    # Generate sample images of the data, with unchanged samples drawn in a random order like the augmented samples.
+    samples = BatchLoader(testing_data, batch, True)
+    # Augment the sample in this process, so shards do not need to be rendered before training starts.
+    data_image(BatchLoader(augmented_training_data, batch, True), name, 'Sample Augmented')
+    data_image(samples, name, 'Sample Unchanged')
     # If new training, write initial files.
     if epoch == 1:
         best_accuracy = accuracy
@@ -335,44 +1298,57 @@ def main(name: str, epochs: int, batch: int, load: bool, wait: int):
         f.close()
         # Create a graph of the model.
         try:
-            y = model.forward(to_tensor(iter(testing).__next__()[0]))
+            y = model.forward(to_images(iter(samples).__next__()[0]))
             make_dot(y.mean(), params=dict(model.named_parameters())).render(f"{os.getcwd()}/Models/{name}/Graph", format="png")
             # Makes redundant file, remove it.
             os.remove(f"{os.getcwd()}/Models/{name}/Graph")
         except:
             "Could not generate graph image, make sure you have 'Graphviz' installed."
-    train_accuracy = test(model, batch, normal_training)
+    # Compile after the graph image is made so it shows every layer.
+    compiled = compile_network(model, batch) if compile_model else None
+    # Without an exact pass, the training accuracy is only known once an epoch has been trained.
+    train_accuracy = evaluate(model, training_evaluation)[0] if exact else "N/A"
     trainable_parameters = sum(p.numel() for p in model.parameters() if p.requires_grad)
-    write_parameters(name, best_accuracy, train_accuracy, inference_time, trainable_parameters, 0, augmented)
+    write_parameters(name, evaluation, train_accuracy, trainable_parameters, 0, augmented, compiled)
     save(name, model, best_model, epoch, no_change, best_accuracy, loss, augmented)
     # Train for set epochs.
     while True:
         if epoch > epochs:
+            if shards > 0:
+                augmented_training.close()
             print("Training finished.")
             return
         augmented_message = "Augmented" if augmented else "Unchanged"
         loss_message = "Loss = " + (f"{loss:.4}" if epoch > 1 else "N/A")
         improvement = "Improvement " if no_change == 0 else f"{no_change} Epochs No Improvement "
         msg = f"Epoch {epoch}/{epochs} | {augmented_message} | {loss_message} | Accuracy = {accuracy:.4}% | Best = {best_accuracy:.4}% | {improvement}"
-        # Reset loss every epoch.
-        loss = 0
+        # Reset loss every epoch, accumulating on the device so there is no synchronization every batch.
+        loss = torch.zeros((), dtype=torch.float64, device=get_processing_device())
+        correct = torch.zeros((), dtype=torch.long, device=get_processing_device())
+        seen = 0
         dataset = augmented_training if augmented else normal_training
-        for raw_image, raw_label in tqdm(dataset, msg):
-            image, label = to_tensor(raw_image), to_tensor(raw_label)
-            loss += model.optimize(image, label)
-        loss /= training_total
+        progress = tqdm(dataset, msg)
+        for step, (raw_image, raw_label) in enumerate(progress):
+            image, label = to_images(raw_image, memory_format=model.memory_format), to_tensor(raw_label)
+            batch_loss, batch_correct = model.optimize(image, label)
+            loss += batch_loss
+            correct += batch_correct
+            seen += len(raw_label)
+            # Only read the running values back at the logging interval.
+            if interval > 0 and step % interval == interval - 1:
+                progress.set_postfix_str(f"Loss = {loss.item() / seen:.4} | Training Accuracy = {correct.item() / seen * 100:.4}%")
+        loss = loss.item() / training_total
         # Check how well the newest epoch performs.
-        start = time.time_ns()
-        accuracy = test(model, batch, testing)
-        end = time.time_ns()
+        evaluation = evaluate(model, testing)
+        accuracy = evaluation[0]
         # Check if this is the new best model.
         if accuracy > best_accuracy:
             best_model = model.state_dict()
             best_accuracy = accuracy
-            inference_time = ((end - start) / testing_total) / 1e+6
             no_change = 0
-            train_accuracy = test(model, batch, normal_training)
-            write_parameters(name, best_accuracy, train_accuracy, inference_time, trainable_parameters, epoch, augmented)
+            # Use the predictions already made while training unless an exact pass over the unchanged training data is requested.
+            train_accuracy = evaluate(model, training_evaluation)[0] if exact else correct.item() / training_total * 100
+            write_parameters(name, evaluation, train_accuracy, trainable_parameters, epoch, augmented, compiled)
         else:
             no_change += 1
         # Save data.
@@ -394,11 +1370,27 @@ if __name__ == '__main__':
         parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=desc)
         parser.add_argument("model", type=str, help="Name of the model, options are \"simple\", \"expanded\", or \"resnet\"")
         parser.add_argument("-e", "--epoch", type=int, help="The number of epochs to train for.", default=100)
-        parser.add_argument("-b", "--batch", type=int, help="Training and testing batch size.", default=64)
+        parser.add_argument("-b", "--batch", type=int, help="Training batch size.", default=64)
         parser.add_argument("-w", "--wait", type=int, help="The number of epochs to wait before switching to augmented data if there are no network improvements.", default=20)
         parser.add_argument("-t", "--test", help="Load and test the model with the given name without performing any training.", action="store_true")
+        parser.add_argument("-r", "--rebuild", help="Rebuild the dataset cache even if \"Data.csv\" has not changed.", action="store_true")
+        parser.add_argument("-n", "--workers", type=int, help="The number of worker processes to parse and load data with, with zero loading in the main process.", default=0)
+        parser.add_argument("-p", "--prefetch", type=int, help="The number of batches each worker loads in advance.", default=2)
+        parser.add_argument("-s", "--seed", type=int, help="The random seed for reproducible shuffling, augmentation, and initialization.", default=None)
+        parser.add_argument("-k", "--shards", type=int, help="The number of pre-augmented copies of the training data to cycle through, with zero augmenting during training.", default=0)
+        parser.add_argument("-z", "--normalize", help="Standardize images with the pixel mean and standard deviation of the training data.", action="store_true")
+        parser.add_argument("-d", "--deduplicated", help="Use the deduplicated dataset built by \"deduplicate.py\".", action="store_true")
+        parser.add_argument("-m", "--mixed", help="Train and test with bfloat16 mixed precision, best on hardware with native bfloat16 support.", action="store_true")
+        parser.add_argument("-c", "--compile", help="Compile the model with \"torch.compile\", caching compiled artifacts in \"Cache/Compiled\".", action="store_true")
+        parser.add_argument("-l", "--channels-last", help="Run the model and its inputs in the channels last memory format, which is often faster for convolutions.", action="store_true")
+        parser.add_argument("-i", "--interval", type=int, help="The number of batches between showing the running loss and accuracy, with zero only reading them at the end of each epoch.", default=0)
+        parser.add_argument("-x", "--exact", help="Measure the training accuracy with a separate pass over the unchanged training data rather than during training.", action="store_true")
+        parser.add_argument("-v", "--eval-batch", type=int, help="The batch size for evaluating.", default=512)
+        parser.add_argument("-a", "--benchmark", help="Benchmark the inference latency and throughput of the model rather than training it.", action="store_true")
+        parser.add_argument("-f", "--export", help="Export the best weights of the model to \"Inference.pt\" rather than training it.", action="store_true")
+        parser.add_argument("-u", "--half", help="Export the weights in half precision.", action="store_true")
         a = vars(parser.parse_args())
-        main(a["model"], a["epoch"], a["batch"], a["test"], a["wait"])
+        main(a["model"], a["epoch"], a["batch"], a["test"], a["wait"], a["rebuild"], a["workers"], a["prefetch"], a["seed"], a["shards"], a["normalize"], a["deduplicated"], a["mixed"], a["compile"], a["channels_last"], a["interval"], a["exact"], a["eval_batch"], a["benchmark"], a["export"], a["half"])
     except KeyboardInterrupt:
         print("Training Stopped.")
     except torch.cuda.OutOfMemoryError:
@@ -2,13 +2,14 @@ from torch import nn, optim
 from torchvision.models import resnet18, ResNet18_Weights
 
 
-def define_layers(name: str):
+def define_layers(name: str, pretrained: bool = True):
     """
     Build the layers of the neural network.
     Convolutional Size =  (Size - Kernel + 2 * Padding) / Stride + 1
     Pooling Size =        (Size + 2 * Padding - Kernel) / Stride + 1
     Flatten Size =        Last Convolutional Out Channels * Size^2
     :param name: The name of the model architecture to use.
+    :param pretrained: True to start from pretrained weights where the architecture uses them, false when they are going to be replaced anyway.
     :return: A sequential layer structure which has a 48x48 single channel starting input layer and a 7 final output layer.
     """
     name = name.lower()
@@ -17,7 +18,7 @@ def define_layers(name: str):
     if name == "expanded":
         return expanded_network()
     if name == "resnet":
-        return resnet_network()
+        return resnet_network(pretrained)
     raise ValueError(f"Model architecture \"{name}\" does not exist, options are \"simple\", \"expanded\", or \"resnet\".")
 
 
@@ -106,13 +107,14 @@ def expanded_network():
     )
 
 
-def resnet_network():
+def resnet_network(pretrained: bool = True):
     """
     Model based on the ResNet18 architecture.
+    :param pretrained: True to start from weights pretrained on ImageNet.
     :return: A ResNet18 based model.
     """
     # ResNet18 network with pretrained weights.
-    net = resnet18(weights=ResNet18_Weights.IMAGENET1K_V1)
+    net = resnet18(weights=ResNet18_Weights.IMAGENET1K_V1 if pretrained else None)
 
     return nn.Sequential(
 
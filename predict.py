@@ -0,0 +1,103 @@
+import argparse
+import os
+
+import numpy
+import pandas
+import torch
+from tqdm import tqdm
+
+import main
+
+
+def predict_csv(model, path: str, output: str, batch: int, chunk: int = main.CHUNK_ROWS):
+    """
+    Predict every image of a CSV in chunks, appending the predictions to the output as they are made so memory use does not grow with the file size.
+    :param model: The neural network.
+    :param path: The path of the CSV, which needs a "pixels" column and can have "emotion" and "id" columns.
+    :param output: The path of the CSV to write the predictions and the probability of every expression to.
+    :param batch: The number of images to predict at once.
+    :param chunk: The number of rows to parse at once.
+    :return: The number of images predicted, and how many were correct if the CSV has an "emotion" column, otherwise None.
+    """
+    columns = list(pandas.read_csv(path, nrows=0).columns)
+    if 'pixels' not in columns:
+        raise ValueError(f"\"{path}\" has no \"pixels\" column.")
+    # Keep any IDs from the CSV, otherwise number the rows.
+    identifier = next((column for column in columns if column.lower() == 'id'), None)
+    labelled = 'emotion' in columns
+    total = 0
+    correct = 0 if labelled else None
+    with open(output, "w", newline="") as file, torch.inference_mode():
+        progress = tqdm(unit=" rows", desc="Predicting")
+        for data in pandas.read_csv(path, chunksize=chunk, usecols=[column for column in columns if column in ['pixels', 'emotion', identifier]]):
+            images = torch.from_numpy(main.parse_pixels(data['pixels'])).unsqueeze(1)
+            predictions, probabilities = [], []
+            for start in range(0, len(images), batch):
+                prediction, probability = model.predict(main.to_images(images[start:start + batch], memory_format=model.memory_format), True)
+                predictions.append(prediction.cpu().numpy())
+                probabilities.append(probability.cpu().numpy())
+            predictions = numpy.concatenate(predictions) if predictions else numpy.zeros(0, dtype=numpy.int64)
+            probabilities = numpy.concatenate(probabilities) if probabilities else numpy.zeros((0, len(main.EXPRESSIONS)), dtype=numpy.float32)
+            results = pandas.DataFrame({
+                'Id': data[identifier].to_numpy() if identifier is not None else numpy.arange(total, total + len(data)),
+                'Emotion': predictions
+            })
+            results[main.EXPRESSIONS] = probabilities
+            # Only the first chunk writes the header.
+            results.to_csv(file, header=total == 0, index=False, float_format="%.6f")
+            if labelled:
+                correct += int((data['emotion'].to_numpy() == predictions).sum())
+            total += len(data)
+            progress.update(len(data))
+        progress.close()
+    return total, correct
+
+
+def main_predict(name: str, path: str, output: str, batch: int, chunk: int, mixed: bool, compile_model: bool, channels_last: bool):
+    """
+    Predict every image of a CSV with a trained model.
+    :param name: The name of the model.
+    :param path: The path of the CSV.
+    :param output: The path of the CSV to write predictions to, or None to write "Predictions.csv" in the model's folder.
+    :param batch: The number of images to predict at once.
+    :param chunk: The number of rows to parse at once.
+    :param mixed: True to predict with bfloat16 mixed precision.
+    :param compile_model: True to compile the model with "torch.compile".
+    :param channels_last: True to run the model and its inputs in the channels last memory format.
+    :return: Nothing.
+    """
+    name = main.model_name(name)
+    if not os.path.exists(path):
+        print(f"\"{path}\" does not exist.")
+        return
+    model = main.load_model(name, mixed, channels_last)
+    if model is None:
+        return
+    if compile_model:
+        main.compile_network(model, batch)
+    if output is None:
+        output = f"{os.getcwd()}/Models/{name}/Predictions.csv"
+    total, correct = predict_csv(model, path, output, max(batch, 1), max(chunk, 1))
+    print(f"Predicted {total} images to \"{output}\".")
+    if correct is not None:
+        print(f"Accuracy = {correct / max(total, 1) * 100}%")
+
+
+if __name__ == '__main__':
+    try:
+        desc = "Face Expression Recognition Batch Prediction\n--------------------------------------------"
+        parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=desc)
+        parser.add_argument("model", type=str, help="The name of the model to predict with.")
+        parser.add_argument("path", type=str, help="The CSV of images to predict.")
+        parser.add_argument("-o", "--output", type=str, help="The CSV to write predictions to, defaulting to \"Predictions.csv\" in the model's folder.", default=None)
+        parser.add_argument("-b", "--batch", type=int, help="The number of images to predict at once.", default=512)
+        parser.add_argument("-k", "--chunk", type=int, help="The number of rows to parse at once.", default=main.CHUNK_ROWS)
+        parser.add_argument("-m", "--mixed", help="Predict with bfloat16 mixed precision.", action="store_true")
+        parser.add_argument("-c", "--compile", help="Compile the model with \"torch.compile\".", action="store_true")
+        parser.add_argument("-l", "--channels-last", help="Run the model and its inputs in the channels last memory format.", action="store_true")
+        a = vars(parser.parse_args())
+        main_predict(a["model"], a["path"], a["output"], a["batch"], a["chunk"], a["mixed"], a["compile"], a["channels_last"])
+    except KeyboardInterrupt:
+        print("Prediction Stopped.")
+    except ValueError as error:
+        print(error)
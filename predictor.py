@@ -0,0 +1,160 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy
+import torch
+
+import main
+
+
+class AsyncPredictor:
+    """
+    Predict images from asyncio code without blocking the event loop, grouping concurrent requests into batches.
+    """
+
+    def __init__(self, model, max_batch: int = 64, max_wait: float = 0.005, max_queue: int = 1024):
+        """
+        Set up the predictor, which starts when first used.
+        :param model: The neural network.
+        :param max_batch: The largest number of images to predict at once, although a single larger request is still predicted at once.
+        :param max_wait: The longest time in seconds to wait for more requests after the first request of a batch.
+        :param max_queue: The largest number of requests which can wait, with more requests waiting until there is room.
+        """
+        self.model = model
+        self.max_batch = max(max_batch, 1)
+        self.max_wait = max(max_wait, 0)
+        self.max_queue = max(max_queue, 1)
+        self.requests = None
+        self.task = None
+        self.closed = False
+        # Predict on a single thread so batches run one after another as they would on the device anyway.
+        self.executor = ThreadPoolExecutor(1)
+
+    async def __aenter__(self):
+        """
+        Start the predictor.
+        :return: The predictor.
+        """
+        self.start()
+        return self
+
+    async def __aexit__(self, *args):
+        """
+        Stop the predictor.
+        :return: Nothing.
+        """
+        await self.close()
+
+    def start(self):
+        """
+        Start grouping requests on the running event loop.
+        :return: Nothing.
+        """
+        if self.task is None:
+            self.requests = asyncio.Queue(self.max_queue)
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def predict(self, images):
+        """
+        Get the probability of every expression for images.
+        :param images: The integer images with values between 0 and 255 of shape (N, 48, 48), or a single image of shape (48, 48).
+        :return: The float32 probabilities of shape (N, 7), or (7,) for a single image.
+        """
+        if self.closed:
+            raise RuntimeError("The predictor has been closed.")
+        # Check the images before queueing them so a bad request cannot fail the whole batch it would be in.
+        images = numpy.asarray(images)
+        if not numpy.issubdtype(images.dtype, numpy.integer):
+            raise ValueError(f"Images must be integers, got {images.dtype}.")
+        if images.ndim not in [2, 3] or images.shape[-2:] != (48, 48) or images.size == 0:
+            raise ValueError(f"Images must be of shape (48, 48) or (N, 48, 48), got {images.shape}.")
+        if images.min() < 0 or images.max() > 255:
+            raise ValueError("Images must have values between 0 and 255.")
+        self.start()
+        images = images.astype(numpy.uint8)
+        single = images.ndim == 2
+        future = asyncio.get_running_loop().create_future()
+        # Waits while the queue is full so callers are slowed down rather than requests piling up.
+        await self.requests.put((images.reshape(-1, 48, 48), future))
+        # The predictor may have been closed while waiting for room.
+        if self.closed:
+            future.cancel()
+        probabilities = await future
+        return probabilities[0] if single else probabilities
+
+    async def run(self):
+        """
+        Group requests into batches and predict them on the worker thread until closed.
+        :return: Nothing.
+        """
+        loop = asyncio.get_running_loop()
+        requests = []
+        # A request which did not fit in the last batch starts the next one.
+        pending = None
+        try:
+            while True:
+                requests = [pending if pending is not None else await self.requests.get()]
+                pending = None
+                total = len(requests[0][0])
+                deadline = loop.time() + self.max_wait
+                # Keep adding requests until the batch is full or the wait is over.
+                while total < self.max_batch:
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        request = await asyncio.wait_for(self.requests.get(), remaining)
+                    except asyncio.TimeoutError:
+                        break
+                    if total + len(request[0]) > self.max_batch:
+                        pending = request
+                        break
+                    requests.append(request)
+                    total += len(request[0])
+                try:
+                    probabilities = await loop.run_in_executor(self.executor, self.predict_batch, [images for images, _ in requests])
+                except Exception as error:
+                    for _, future in requests:
+                        if not future.done():
+                            future.set_exception(error)
+                    continue
+                start = 0
+                for images, future in requests:
+                    # Callers which were cancelled no longer need their results.
+                    if not future.done():
+                        future.set_result(probabilities[start:start + len(images)])
+                    start += len(images)
+        finally:
+            # Requests taken from the queue when closed would otherwise never finish.
+            for _, future in requests + ([pending] if pending is not None else []):
+                if not future.done():
+                    future.cancel()
+
+    def predict_batch(self, images):
+        """
+        Predict the images of multiple requests at once.
+        :param images: The images of every request.
+        :return: The probabilities of every image.
+        """
+        images = torch.from_numpy(numpy.concatenate(images)).unsqueeze(1)
+        return self.model.predict(main.to_images(images, memory_format=self.model.memory_format), True)[1].cpu().numpy()
+
+    async def close(self):
+        """
+        Stop predicting, cancelling any requests which are still waiting.
+        :return: Nothing.
+        """
+        self.closed = True
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            # Taking a request lets a caller waiting for room add theirs, so keep going until none are left.
+            while not self.requests.empty():
+                self.requests.get_nowait()[1].cancel()
+                await asyncio.sleep(0)
+            self.task = None
+        # Do not block the event loop waiting for a batch which is still being predicted.
+        self.executor.shutdown(wait=False)
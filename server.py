@@ -0,0 +1,262 @@
+import argparse
+import json
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy
+import torch
+
+import main
+
+
+class MicroBatcher:
+    """
+    Group images from concurrent requests into batches so the network predicts them together.
+    """
+
+    def __init__(self, model, max_batch: int, max_wait: float):
+        """
+        Start predicting batches in a background thread.
+        :param model: The neural network.
+        :param max_batch: The largest number of images to predict at once, although a single larger request is still predicted at once.
+        :param max_wait: The longest time in seconds to wait for more requests after the first request of a batch.
+        """
+        self.model = model
+        self.max_batch = max(max_batch, 1)
+        self.max_wait = max(max_wait, 0)
+        self.requests = queue.Queue()
+        # How many batches were predicted with each batch size, and how many requests were waiting when each batch was started.
+        self.batch_sizes = {}
+        self.queue_depths = {}
+        self.lock = threading.Lock()
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def predict(self, images):
+        """
+        Predict images, waiting until the batch they are in has been predicted.
+        :param images: The uint8 images of shape (N, 48, 48).
+        :return: The predicted labels and the probability of every expression.
+        """
+        request = {'Images': images, 'Done': threading.Event()}
+        self.requests.put(request)
+        request['Done'].wait()
+        if 'Error' in request:
+            raise request['Error']
+        return request['Predictions'], request['Probabilities']
+
+    def run(self):
+        """
+        Predict batches of requests until the program exits.
+        :return: Nothing.
+        """
+        # A request which did not fit in the last batch starts the next one.
+        pending = None
+        while True:
+            requests = [pending if pending is not None else self.requests.get()]
+            pending = None
+            depth = self.requests.qsize() + 1
+            total = len(requests[0]['Images'])
+            deadline = time.perf_counter() + self.max_wait
+            # Keep adding requests until the batch is full or the wait is over.
+            while total < self.max_batch:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    request = self.requests.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if total + len(request['Images']) > self.max_batch:
+                    pending = request
+                    break
+                requests.append(request)
+                total += len(request['Images'])
+            # Record the batch before its requests finish so their callers see it in the statistics.
+            with self.lock:
+                self.batch_sizes[total] = self.batch_sizes.get(total, 0) + 1
+                self.queue_depths[depth] = self.queue_depths.get(depth, 0) + 1
+            self.predict_batch(requests)
+
+    def predict_batch(self, requests):
+        """
+        Predict the images of requests at once and give each request its results.
+        :param requests: The requests.
+        :return: Nothing.
+        """
+        try:
+            images = torch.from_numpy(numpy.concatenate([request['Images'] for request in requests])).unsqueeze(1)
+            predictions, probabilities = self.model.predict(main.to_images(images, memory_format=self.model.memory_format), True)
+            predictions, probabilities = predictions.cpu().numpy(), probabilities.cpu().numpy()
+            start = 0
+            for request in requests:
+                end = start + len(request['Images'])
+                request['Predictions'], request['Probabilities'] = predictions[start:end], probabilities[start:end]
+                start = end
+        except Exception as error:
+            for request in requests:
+                request['Error'] = error
+        for request in requests:
+            request['Done'].set()
+
+    def statistics(self):
+        """
+        Get the current queue depth and the histograms of batch sizes and queue depths.
+        :return: The statistics.
+        """
+        with self.lock:
+            return {
+                'Queue Depth': self.requests.qsize(),
+                'Batch Sizes': {str(size): count for size, count in sorted(self.batch_sizes.items())},
+                'Queue Depths': {str(depth): count for depth, count in sorted(self.queue_depths.items())}
+            }
+
+
+def read_images(body: bytes, content_type: str):
+    """
+    Read the images of a request.
+    :param body: The body of the request.
+    :param content_type: The content type of the request.
+    :return: The uint8 images of shape (N, 48, 48).
+    """
+    # Raw pixels are sent as bytes, one byte per pixel.
+    if content_type.startswith("application/octet-stream"):
+        if len(body) == 0 or len(body) % (48 * 48) != 0:
+            raise ValueError(f"Raw pixels must be a multiple of {48 * 48} bytes, got {len(body)}.")
+        return numpy.frombuffer(body, dtype=numpy.uint8).reshape(-1, 48, 48)
+    data = json.loads(body)
+    if not isinstance(data, dict):
+        raise ValueError("Requests must be a JSON object.")
+    # Pixel strings are in the same format as the "pixels" column of "Data.csv".
+    if 'pixels' in data:
+        pixels = data['pixels']
+        return main.parse_pixels([pixels] if isinstance(pixels, str) else pixels)
+    if 'images' in data:
+        images = numpy.asarray(data['images'], dtype=numpy.int64)
+        if images.size == 0 or images.size % (48 * 48) != 0 or images.min() < 0 or images.max() > 255:
+            raise ValueError(f"Images must be {48 * 48} pixels each with values between 0 and 255.")
+        return images.astype(numpy.uint8).reshape(-1, 48, 48)
+    raise ValueError("Requests need either \"pixels\" or \"images\".")
+
+
+def make_handler(batcher: MicroBatcher):
+    """
+    Make a request handler which predicts with a micro-batcher.
+    :param batcher: The micro-batcher.
+    :return: The request handler class.
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        """
+        Handle prediction and statistics requests.
+        """
+
+        def do_GET(self):
+            """
+            Send the queue depth and the histograms of batch sizes and queue depths.
+            :return: Nothing.
+            """
+            if self.path != "/stats":
+                self.respond(404, {'Error': f"Unknown path \"{self.path}\"."})
+                return
+            self.respond(200, batcher.statistics())
+
+        def do_POST(self):
+            """
+            Predict the images of a request.
+            :return: Nothing.
+            """
+            if self.path != "/predict":
+                self.respond(404, {'Error': f"Unknown path \"{self.path}\"."})
+                return
+            # Any request which cannot be read is the client's error.
+            try:
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                images = read_images(body, self.headers.get("Content-Type", "application/json"))
+            except Exception as error:
+                self.respond(400, {'Error': f"Invalid request: {error}"})
+                return
+            try:
+                predictions, probabilities = batcher.predict(images)
+            except Exception as error:
+                self.respond(500, {'Error': f"Prediction failed: {error}"})
+                return
+            self.respond(200, {
+                'Predictions': predictions.tolist(),
+                'Expressions': [main.EXPRESSIONS[prediction] for prediction in predictions],
+                'Probabilities': probabilities.tolist()
+            })
+
+        def respond(self, status: int, data):
+            """
+            Send a JSON response.
+            :param status: The HTTP status code.
+            :param data: The data to send.
+            :return: Nothing.
+            """
+            body = json.dumps(data).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            """
+            Do not log every request, as doing so slows down the server.
+            :return: Nothing.
+            """
+            pass
+
+    return Handler
+
+
+def main_server(name: str, host: str, port: int, max_batch: int, max_wait: float, mixed: bool, compile_model: bool, channels_last: bool):
+    """
+    Serve predictions of a trained model over HTTP.
+    :param name: The name of the model.
+    :param host: The host to listen on.
+    :param port: The port to listen on.
+    :param max_batch: The largest number of images to predict at once.
+    :param max_wait: The longest time in milliseconds to wait for more requests after the first request of a batch.
+    :param mixed: True to predict with bfloat16 mixed precision.
+    :param compile_model: True to compile the model with "torch.compile".
+    :param channels_last: True to run the model and its inputs in the channels last memory format.
+    :return: Nothing.
+    """
+    name = main.model_name(name)
+    print(f"Loading model '{name}'...")
+    model = main.load_model(name, mixed, channels_last)
+    if model is None:
+        return
+    if compile_model:
+        main.compile_network(model, max_batch)
+    batcher = MicroBatcher(model, max_batch, max_wait / 1000)
+    server = ThreadingHTTPServer((host, port), make_handler(batcher))
+    print(f"Serving '{name}' at http://{host}:{port}/predict with statistics at http://{host}:{port}/stats.")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    try:
+        desc = "Face Expression Recognition Server\n----------------------------------"
+        parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=desc)
+        parser.add_argument("model", type=str, help="The name of the model to serve.")
+        parser.add_argument("-o", "--host", type=str, help="The host to listen on.", default="127.0.0.1")
+        parser.add_argument("-p", "--port", type=int, help="The port to listen on.", default=8000)
+        parser.add_argument("-b", "--batch", type=int, help="The largest number of images to predict at once.", default=64)
+        parser.add_argument("-w", "--wait", type=float, help="The longest time in milliseconds to wait for more requests after the first request of a batch.", default=5)
+        parser.add_argument("-m", "--mixed", help="Predict with bfloat16 mixed precision.", action="store_true")
+        parser.add_argument("-c", "--compile", help="Compile the model with \"torch.compile\".", action="store_true")
+        parser.add_argument("-l", "--channels-last", help="Run the model and its inputs in the channels last memory format.", action="store_true")
+        a = vars(parser.parse_args())
+        main_server(a["model"], a["host"], a["port"], a["batch"], a["wait"], a["mixed"], a["compile"], a["channels_last"])
+    except KeyboardInterrupt:
+        print("Server Stopped.")
+    except ValueError as error:
+        print(error)